@@ -0,0 +1,133 @@
+import os
+import sys
+import json
+import struct
+
+# maps changed files to the execs that have to be rebuilt: the headers come
+# from ninja's deps log, the rest from the graph written by shuriken
+
+SOURCE_EXTS = ('.c', '.cpp')
+
+def read_deps(path):
+    # .ninja_deps: a path record is the path padded to 4 bytes and its
+    # checksum, a deps record (high bit of the size set) is the output id,
+    # its mtime and the ids of its inputs; a later record of an output
+    # replaces the earlier ones
+    with open(path, 'rb') as f:
+        data = f.read()
+    if not data.startswith(b'# ninjadeps\n') or len(data) < 16:
+        return None
+    version = struct.unpack_from('<i', data, 12)[0]
+    if version not in (3, 4):
+        return None
+    mtime_size = 8 if version == 4 else 4
+    paths = []
+    deps = {}
+    pos = 16
+    while pos + 4 <= len(data):
+        head = struct.unpack_from('<I', data, pos)[0]
+        size = head & 0x7fffffff
+        pos += 4
+        if pos + size > len(data):
+            break
+        if head >> 31:
+            out = struct.unpack_from('<i', data, pos)[0]
+            count = (size - 4 - mtime_size) // 4
+            ids = struct.unpack_from('<{0}i'.format(count), data, pos + 4 + mtime_size)
+            deps[out] = ids
+        else:
+            paths.append(data[pos:pos + size - 4].rstrip(b'\0').decode())
+        pos += size
+    return dict((paths[out], [paths[i] for i in ids]) for out, ids in deps.items() if out < len(paths))
+
+def ninja_deps(build_dir):
+    # the same through ninja itself, for deps logs of another version
+    import subprocess
+    try:
+        text = subprocess.run(['ninja', '-t', 'deps'], stdout=subprocess.PIPE, universal_newlines=True).stdout
+    except OSError:
+        return {}
+    deps = {}
+    output = None
+    for line in text.splitlines():
+        if line.startswith('    ') and output is not None:
+            deps[output].append(line.strip())
+        elif ': #deps' in line:
+            output = line.split(': #deps')[0]
+            deps[output] = []
+    return deps
+
+def normalize(path, top):
+    path = os.path.normpath(os.path.join(top, path))
+    rel = os.path.relpath(path, top)
+    return path if rel.startswith('..') else rel.replace(os.sep, '/')
+
+def affected(changed, build_dir='ninja', graph_file=None, stamp_file=None, tests=False):
+    # names and outputs of the execs reached from the changed files, or
+    # only of the tests
+    top = os.getcwd()
+    graph_file = graph_file or os.path.join(build_dir, 'shuriken.json')
+    stamp_file = stamp_file or os.path.join(build_dir, 'build.ninja.stamp')
+    with open(graph_file) as f:
+        graph = json.load(f)
+    deps = None
+    if os.path.isfile(os.path.join(build_dir, '.ninja_deps')):
+        deps = read_deps(os.path.join(build_dir, '.ninja_deps'))
+    if deps is None:
+        deps = ninja_deps(build_dir)
+    scanned = {}
+    try:
+        with open(stamp_file) as f:
+            stamp = json.load(f)
+        scanned = dict(stamp.get('inputs', {}), **stamp.get('listings', {}))
+    except (IOError, ValueError):
+        pass
+
+    users = {}
+    for output, node in graph.items():
+        for inp in node['inputs'] + node['sources']:
+            users.setdefault(normalize(inp, top), set()).add(output)
+    for output, inputs in deps.items():
+        for inp in inputs:
+            users.setdefault(normalize(inp, top), set()).add(output)
+
+    wanted = []
+    for path in changed:
+        path = normalize(path, top)
+        if path in scanned and not os.path.isdir(path):
+            # the metal file or a .cfg: the manifest itself changes
+            wanted = list(graph)
+            break
+        if path not in users and path.endswith(SOURCE_EXTS) and (os.path.dirname(path) or '.') in scanned:
+            # a new source some selector may pick up
+            wanted = list(graph)
+            break
+        wanted.append(path)
+    seen = set(wanted)
+    while wanted:
+        for output in users.get(wanted.pop(), ()):
+            if output not in seen:
+                seen.add(output)
+                wanted.append(output)
+    links = sorted(o for o in seen if graph.get(o, {}).get('rule') == 'link' and (not tests or graph[o].get('test')))
+    names = sorted(set(t for o in links for t in graph[o]['targets']))
+    return names, links
+
+def main(args):
+    import argparse
+    parser = argparse.ArgumentParser(prog='shuriken affected', description='list the execs a change affects')
+    parser.add_argument('files', nargs='*', help='changed files, relative to the metal folder')
+    parser.add_argument('--outputs', action='store_true', help='print the exec outputs, ready to give to ninja')
+    parser.add_argument('--builddir', default='ninja', help='ninja builddir holding .ninja_deps')
+    parser.add_argument('--tests', action='store_true', help="only the tests, names ready to give to 'shuriken test'")
+    opts = parser.parse_args(args)
+    if not os.path.isfile(os.path.join(opts.builddir, 'shuriken.json')):
+        print('-- no shuriken graph at', os.path.join(opts.builddir, 'shuriken.json'), '(run shuriken first)', file=sys.stderr)
+        return 1
+    names, links = affected(opts.files, opts.builddir, tests=opts.tests)
+    for line in links if opts.outputs else names:
+        print(line)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
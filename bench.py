@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import subprocess
+
+# generator benchmarks on synthetic projects; every measurement runs in a
+# child process, so the peak memory reported belongs to that run alone
+
+HERE = os.path.dirname(os.path.realpath(__file__))
+PHASES = ['config_discovery', 'cfg_parsing', 'glob_resolution', 'ninja_emission']
+SOURCES_PER_DIR = 50
+MODULES = 20
+CONFIGLIBS = 40
+
+def write_tree(root, sources):
+    # core/ plus MODULES modules with nested folders, 1 in 5 sources in C,
+    # execs selecting overlapping parts of it and CONFIGLIBS .cfg files
+    dirs = max(1, sources // SOURCES_PER_DIR)
+    folders = []
+    for idx in range(dirs):
+        if idx % 10 == 0:
+            folders.append('core/part{0}'.format(idx))
+        else:
+            module = idx % MODULES
+            folders.append('mod{0}/sub{1}/leaf{2}'.format(module, idx % 3, idx))
+    written = 0
+    for idx, folder in enumerate(folders):
+        os.makedirs(os.path.join(root, folder), exist_ok=True)
+        count = SOURCES_PER_DIR if idx < len(folders) - 1 else sources - written
+        for num in range(count):
+            ext = '.c' if num % 5 == 0 else '.cpp'
+            name = 'f{0}_{1}{2}'.format(idx, num, ext)
+            with open(os.path.join(root, folder, name), 'w') as out:
+                out.write('int f{0}_{1}(void);\n'.format(idx, num))
+        written += count
+
+    configs = os.path.join(root, 'config')
+    os.makedirs(configs, exist_ok=True)
+    for num in range(CONFIGLIBS):
+        with open(os.path.join(configs, 'lib{0}.cfg'.format(num)), 'w') as out:
+            out.write('info "synthetic library {0}\n  spanning two lines"\n'.format(num))
+            out.write('path /opt/lib{0}\n'.format(num))
+            out.write('compiler -I$path$/include -DLIB{0}=1\n'.format(num))
+            out.write('linker -L$path$/lib -Wl,-rpath,$path$/lib\n')
+            out.write('libs -llib{0}\n'.format(num))
+
+    with open(os.path.join(root, 'metal'), 'w') as out:
+        for num in range(CONFIGLIBS):
+            out.write('configlib lib{0}\n'.format(num))
+        for module in range(MODULES):
+            libs = ' '.join('lib{0}'.format((module + k) % CONFIGLIBS) for k in range(3))
+            out.write('exec mod{0} core/**/*.cpp mod{0}/**/*.cpp mod{0}/**/*.c -mod{0}/sub0/*/f*_1.cpp using {1}\n'.format(module, libs))
+            out.write('exec test{0} core/**/*.cpp mod{0}/sub1/**/*.cpp using {1}\n'.format(module, libs))
+        out.write('exec everything **/*.cpp **/*.c\n')
+    return configs
+
+class phase_timer():
+    def __init__(self):
+        self.phases = dict((p, 0.0) for p in PHASES)
+
+    def wrap(self, owner, attr, phase):
+        original = getattr(owner, attr)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                self.phases[phase] += time.perf_counter() - start
+        setattr(owner, attr, timed)
+
+def run_child(generator, tree):
+    import resource
+    sys.path.insert(0, HERE)
+    import shuriken
+    timer = phase_timer()
+    os.chdir(tree)
+    start = time.perf_counter()
+    if generator == 'shuriken':
+        timer.wrap(shuriken, 'get_config_files', 'config_discovery')
+        timer.wrap(shuriken.metal_parser, 'line_configlib', 'cfg_parsing')
+        timer.wrap(shuriken.metal_parser, 'line_exec', 'glob_resolution')
+        timer.wrap(shuriken.metal_parser, 'gen_ninja', 'ninja_emission')
+        shuriken.shuriken(os.path.join(tree, 'metal'))
+    else:
+        import s
+        timer.wrap(s.MetalParser, 'set_found_configs', 'config_discovery')
+        timer.wrap(s.MetalParser, 'parse_configlib', 'cfg_parsing')
+        timer.wrap(s.MetalParser, 'parse_exec', 'glob_resolution')
+        timer.wrap(s.MetalParser, '_gen_ninja', 'ninja_emission')
+        parser = s.MetalParser()
+        parser.set_found_configs()
+        parser.parse('metal')
+    total = time.perf_counter() - start
+    return dict(phases=timer.phases, total=total,
+                peak_rss_kb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                manifest_bytes=os.path.getsize(os.path.join(tree, 'build.ninja')))
+
+def measure(generator, tree, configs, seed=None):
+    env = dict(os.environ, SHURIKEN_CONFIG_DIR=configs)
+    if seed is not None:
+        env['PYTHONHASHSEED'] = str(seed)
+    proc = subprocess.run([sys.executable, os.path.realpath(__file__), '--child', generator, tree],
+                          env=env, stdout=subprocess.PIPE, check=True)
+    return json.loads(proc.stdout.decode().splitlines()[-1])
+
+def bench(sizes, generators, workdir):
+    results = []
+    for size in sizes:
+        tree = os.path.join(workdir, 'tree{0}'.format(size))
+        shutil.rmtree(tree, ignore_errors=True)
+        configs = write_tree(tree, size)
+        for generator in generators:
+            # cold: no parsed config cache nor stamp, warm: cached configs,
+            # noop: nothing changed since the last run
+            modes = ['cold', 'warm', 'noop'] if generator == 'shuriken' else ['cold', 'warm']
+            for mode in modes:
+                if mode == 'cold':
+                    for leftover in [os.path.join(configs, 'cache.json'), os.path.join(tree, 'build.ninja')]:
+                        if os.path.exists(leftover):
+                            os.remove(leftover)
+                if mode != 'noop' and os.path.exists(os.path.join(tree, 'ninja', 'build.ninja.stamp')):
+                    os.remove(os.path.join(tree, 'ninja', 'build.ninja.stamp'))
+                result = measure(generator, tree, configs)
+                result.update(generator=generator, sources=size, mode=mode)
+                results.append(result)
+                print('{0:>8} {1:>7} {2:>5}  total {3:8.3f}s  peak {4:8d} KB  manifest {5:10d} B'.format(
+                    generator, size, mode, result['total'], result['peak_rss_kb'], result['manifest_bytes']), file=sys.stderr)
+        shutil.rmtree(tree, ignore_errors=True)
+    return results
+
+def check_determinism(sizes, generators, workdir, seeds=(1, 2, 3)):
+    # cold runs under different string hashes must write the same bytes, a
+    # changed command line makes ninja rebuild everything
+    import hashlib
+    failed = []
+    for size in sizes:
+        tree = os.path.join(workdir, 'tree{0}'.format(size))
+        shutil.rmtree(tree, ignore_errors=True)
+        configs = write_tree(tree, size)
+        for generator in generators:
+            digests = set()
+            for seed in seeds:
+                for leftover in ['build.ninja', os.path.join('ninja', 'build.ninja.stamp'), os.path.join('config', 'cache.json')]:
+                    if os.path.exists(os.path.join(tree, leftover)):
+                        os.remove(os.path.join(tree, leftover))
+                measure(generator, tree, configs, seed)
+                with open(os.path.join(tree, 'build.ninja'), 'rb') as f:
+                    digests.add(hashlib.sha256(f.read()).hexdigest())
+            state = 'ok' if len(digests) == 1 else 'differs'
+            print('{0:>8} {1:>7}  {2}'.format(generator, size, state), file=sys.stderr)
+            if len(digests) != 1:
+                failed.append((generator, size))
+        shutil.rmtree(tree, ignore_errors=True)
+    return failed
+
+def main(args):
+    import argparse
+    import platform
+    parser = argparse.ArgumentParser(description='benchmark the ninja generators on synthetic projects')
+    parser.add_argument('--sizes', default='1000,10000,100000', help='comma separated source counts')
+    parser.add_argument('--generators', default='shuriken,s', help='comma separated: shuriken (shuriken.py) and s (s.py)')
+    parser.add_argument('--workdir', help='where the synthetic trees are written, a temporary folder by default')
+    parser.add_argument('-o', '--output', help='write the json results here instead of stdout')
+    parser.add_argument('--determinism', action='store_true', help='only check that runs under different hash seeds write the same build.ninja')
+    parser.add_argument('--child', nargs=2, help=argparse.SUPPRESS)
+    opts = parser.parse_args(args)
+    if opts.child:
+        print(json.dumps(run_child(*opts.child)))
+        return 0
+
+    workdir = opts.workdir or tempfile.mkdtemp(prefix='shuriken-bench-')
+    if opts.determinism:
+        failed = check_determinism([int(s) for s in opts.sizes.split(',')], opts.generators.split(','), workdir)
+        if not opts.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+        return 1 if failed else 0
+    results = bench([int(s) for s in opts.sizes.split(',')], opts.generators.split(','), workdir)
+    if not opts.workdir:
+        shutil.rmtree(workdir, ignore_errors=True)
+    doc = dict(python=platform.python_version(), platform=platform.platform(),
+               time=time.strftime('%Y-%m-%dT%H:%M:%S'), results=results)
+    if opts.output:
+        with open(opts.output, 'w') as out:
+            json.dump(doc, out, indent=1, sort_keys=True)
+    else:
+        json.dump(doc, sys.stdout, indent=1, sort_keys=True)
+        print()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
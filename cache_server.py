@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+import os
+import re
+import sys
+import threading
+import http.server
+
+# reference remote for objcache.py: GET and PUT of /<key>.o and /<key>.dwo
+# kept in a plain folder, laid out like the local cache; enough for a few
+# machines or for trying the remote cache out on one
+
+NAME = re.compile(r'^/([0-9a-f]{64})(\.o|\.dwo)$')
+MAX_OBJECT = 256 << 20
+
+class cache_handler(http.server.BaseHTTPRequestHandler):
+    folder = '.'
+    counter = 0
+    lock = threading.Lock()
+
+    def path_of(self):
+        match = NAME.match(self.path)
+        if match is None:
+            return None
+        key, suffix = match.groups()
+        return os.path.join(self.folder, key[:2], key[2:] + suffix)
+
+    def reply(self, code, body=b''):
+        self.send_response(code)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if body and self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def do_GET(self):
+        path = self.path_of()
+        if path is None:
+            return self.reply(400)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return self.reply(404)
+        self.reply(200, data)
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_PUT(self):
+        path = self.path_of()
+        size = int(self.headers.get('Content-Length') or -1)
+        if path is None or size < 0 or size > MAX_OBJECT:
+            return self.reply(400)
+        data = self.rfile.read(size)
+        if len(data) != size:
+            return self.reply(400)
+        # the same key is always the same object, concurrent uploads of it
+        # just replace each other
+        with self.lock:
+            cache_handler.counter += 1
+            tmp = '{0}.{1}.tmp'.format(path, cache_handler.counter)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp, 'wb') as out:
+            out.write(data)
+        os.replace(tmp, path)
+        self.reply(201)
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            http.server.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+def serve(folder, host='', port=8080, quiet=False):
+    os.makedirs(folder, exist_ok=True)
+    cache_handler.folder = folder
+    server = http.server.ThreadingHTTPServer((host, port), cache_handler)
+    server.quiet = quiet
+    print('-- serving', folder, 'on port', server.server_address[1])
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    return 0
+
+def main(args):
+    import argparse
+    parser = argparse.ArgumentParser(prog='shuriken cache-server', description='serve a folder as a remote object cache')
+    parser.add_argument('folder', help='where the objects are kept')
+    parser.add_argument('--host', default='', help='address to listen on, every one by default')
+    parser.add_argument('-p', '--port', type=int, default=8080)
+    parser.add_argument('-q', '--quiet', action='store_true', help="don't log every request")
+    opts = parser.parse_args(args)
+    return serve(opts.folder, opts.host, opts.port, opts.quiet)
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+import os
+import sys
+import hashlib
+import subprocess
+
+# runs the command of a generate line from the file ninja wrote it to; an
+# output written again with the same bytes gets its previous mtime back,
+# which restat needs to skip everything depending on it
+
+def snapshot(path):
+    try:
+        st = os.stat(path)
+        with open(path, 'rb') as f:
+            digest = hashlib.sha256(f.read()).digest()
+    except OSError:
+        return None
+    return st.st_atime_ns, st.st_mtime_ns, digest
+
+def main(args):
+    # generate.py <command file> <outputs...>
+    if len(args) < 2:
+        print('usage: generate.py COMMAND_FILE OUTPUTS...')
+        return 2
+    cmdfile, outputs = args[0], args[1:]
+    with open(cmdfile) as f:
+        command = f.read()
+    before = dict((path, snapshot(path)) for path in outputs)
+    code = subprocess.call(command, shell=True)
+    if code != 0:
+        return code
+    for path in outputs:
+        if not os.path.isfile(path):
+            print('generate: the command did not write', path)
+            return 1
+        old = before[path]
+        if old is not None and snapshot(path)[2] == old[2]:
+            os.utime(path, ns=old[:2])
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
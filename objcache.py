@@ -0,0 +1,443 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import fcntl
+import shutil
+import hashlib
+import subprocess
+import time
+
+# compiler wrapper put in front of the compile rules by 'cache' in metal:
+# an object is looked up by a hash of the preprocessed source, the compiler
+# and the flags, and copied from the cache instead of compiled when found;
+# with a remote cache (cache_server.py or anything answering GET and PUT of
+# /<key>.o) a local miss is fetched from there and a compile uploaded to it
+
+CACHE_VERSION = '1'
+DEFAULT_MAX_SIZE = 5 << 30
+# seconds, a slow or gone remote costs at most this per request before the
+# compile goes on locally
+REMOTE_TIMEOUT = 2.0
+# uploads running at the same time, for the whole cache folder
+UPLOAD_JOBS = 4
+# seconds the end of a build waits for the queued uploads at most, the
+# ones left are uploaded by the next build
+FLUSH_TIMEOUT = 30.0
+STATS = ['hits', 'misses', 'uncacheable', 'size', 'evicted', 'remote_hits', 'remote_misses', 'remote_errors', 'uploads', 'upload_errors']
+
+def cache_dir():
+    return os.environ.get('SHURIKEN_CACHE_DIR') or os.path.join(os.path.expanduser('~'), '.cache', 'shuriken')
+
+def parse_size(text):
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+    text = text.strip().upper()
+    if text[-1:] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+class locked_stats():
+    # hits, misses and the size of the cache, shared by every compile
+    # running at the same time
+    def __init__(self, folder):
+        self.path = os.path.join(folder, 'stats.json')
+        self.lock_path = os.path.join(folder, 'lock')
+
+    def __enter__(self):
+        self.lock = open(self.lock_path, 'a')
+        fcntl.flock(self.lock, fcntl.LOCK_EX)
+        try:
+            with open(self.path) as f:
+                self.stats = json.load(f)
+        except (IOError, ValueError):
+            self.stats = {}
+        for name in STATS:
+            self.stats.setdefault(name, 0)
+        return self.stats
+
+    def __exit__(self, kind, value, traceback):
+        if kind is None:
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as out:
+                json.dump(self.stats, out)
+            os.replace(tmp, self.path)
+        fcntl.flock(self.lock, fcntl.LOCK_UN)
+        self.lock.close()
+        return False
+
+def entries(folder):
+    for sub in os.listdir(folder):
+        if len(sub) != 2:
+            continue
+        for name in os.listdir(os.path.join(folder, sub)):
+            if not name.endswith('.tmp'):
+                yield os.path.join(folder, sub, name)
+
+def evict(folder, max_size):
+    # least recently used first, a hit touches its entry; down to 90% so
+    # the next stores don't evict again right away
+    found = []
+    for path in entries(folder):
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        found.append((st.st_mtime, st.st_size, path))
+    found.sort()
+    size = sum(f[1] for f in found)
+    removed = 0
+    for mtime, bytes_, path in found:
+        if size <= max_size * 9 // 10:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        size -= bytes_
+        removed += 1
+    return size, removed
+
+def split_args(args):
+    # the compile rules always end with -c $in -o $out, anything else isn't
+    # cached
+    if '-c' not in args or '-o' not in args:
+        return None
+    idx = args.index('-c')
+    out_idx = args.index('-o')
+    if idx + 1 >= len(args) or out_idx + 1 >= len(args) or args[idx + 1].startswith('-') or '-x' in args:
+        return None
+    source = args[idx + 1]
+    output = args[out_idx + 1]
+    rest = [a for i, a in enumerate(args) if i not in (idx, idx + 1, out_idx, out_idx + 1)]
+    return source, output, rest
+
+def compiler_identity(compiler):
+    path = shutil.which(compiler) or compiler
+    real = os.path.realpath(path)
+    st = os.stat(real)
+    return '{0}\0{1}\0{2}'.format(real, st.st_mtime_ns, st.st_size)
+
+def cache_key(compiler, source, output, rest):
+    # the preprocessed source stands for every header it includes; its
+    # -MMD writes the depfile exactly like the compile would have
+    digest = hashlib.sha256()
+    digest.update(CACHE_VERSION.encode())
+    digest.update(compiler_identity(compiler).encode())
+    preprocess = [compiler]
+    skip = False
+    for idx, arg in enumerate(rest):
+        if skip:
+            skip = False
+            continue
+        if arg == '-include' and idx + 1 < len(rest) and os.path.isfile(rest[idx + 1] + '.gch') and not os.path.isfile(rest[idx + 1]):
+            # a precompiled header only exists as its .gch, which -E can't
+            # read; gcc doesn't write the same .gch twice, the key of the
+            # header written next to it is the same on every machine
+            gch = rest[idx + 1] + '.gch'
+            if os.path.isfile(gch + '.key') and os.path.getmtime(gch + '.key') >= os.path.getmtime(gch):
+                with open(gch + '.key', 'rb') as f:
+                    digest.update(f.read())
+            else:
+                with open(gch, 'rb') as f:
+                    digest.update(hashlib.sha256(f.read()).digest())
+            skip = True
+            continue
+        preprocess.append(arg)
+        if arg in ('-MF', '-MT', '-MQ'):
+            continue
+        if idx > 0 and rest[idx - 1] in ('-MF', '-MT', '-MQ'):
+            continue
+        digest.update(arg.encode() + b'\0')
+    proc = subprocess.run(preprocess + ['-E', source], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    if proc.returncode != 0:
+        return None
+    digest.update(proc.stdout)
+    if any(a.startswith('-g') and a != '-g0' for a in rest):
+        # the debug info knows the folder it was built in
+        digest.update(os.getcwd().encode())
+    if '-gsplit-dwarf' in rest:
+        # and the object names its .dwo
+        digest.update(output.encode())
+    return digest.hexdigest()
+
+def copy_atomic(source, target):
+    tmp = '{0}.{1}.tmp'.format(target, os.getpid())
+    shutil.copyfile(source, tmp)
+    os.replace(tmp, target)
+
+def remote_url(remote, key, suffix):
+    return '{0}/{1}{2}'.format(remote.rstrip('/'), key, suffix)
+
+def remote_get(remote, key, entry, suffixes, timeout):
+    # into the local cache, so the next lookup is a local hit; a 404 is a
+    # miss, anything else going wrong an error, the compile runs either way
+    import urllib.request
+    import urllib.error
+    fetched = []
+    try:
+        for suffix in suffixes:
+            with urllib.request.urlopen(remote_url(remote, key, suffix), timeout=timeout) as resp:
+                data = resp.read()
+            tmp = '{0}{1}.{2}.tmp'.format(entry, suffix, os.getpid())
+            with open(tmp, 'wb') as out:
+                out.write(data)
+            fetched.append((tmp, entry + suffix, len(data)))
+    except urllib.error.HTTPError as e:
+        state = 'remote_misses' if e.code == 404 else 'remote_errors'
+    except (OSError, ValueError):
+        state = 'remote_errors'
+    else:
+        state = 'remote_hits'
+    size = 0
+    for tmp, path, bytes_ in fetched:
+        if state == 'remote_hits':
+            os.replace(tmp, path)
+            size += bytes_
+        else:
+            os.remove(tmp)
+    return state, size
+
+def remote_put(remote, key, entry, timeout):
+    import urllib.request
+    for suffix in ['.o', '.dwo']:
+        if not os.path.isfile(entry + suffix):
+            continue
+        with open(entry + suffix, 'rb') as f:
+            data = f.read()
+        request = urllib.request.Request(remote_url(remote, key, suffix), data=data, method='PUT',
+                                         headers={'Content-Type': 'application/octet-stream'})
+        with urllib.request.urlopen(request, timeout=timeout) as resp:
+            resp.read()
+
+def upload_later(remote, key, timeout):
+    # queued in the cache folder and drained by a single detached uploader,
+    # started when none runs; neither this wrapper nor ninja waits for it
+    folder = cache_dir()
+    queue = os.path.join(folder, 'uploads')
+    os.makedirs(queue, exist_ok=True)
+    tmp = os.path.join(queue, '{0}.{1}.tmp'.format(key, os.getpid()))
+    with open(tmp, 'w') as out:
+        out.write('{0}\n{1}\n'.format(remote, timeout))
+    os.replace(tmp, os.path.join(queue, key))
+    with open(os.path.join(folder, 'uploads.lock'), 'a') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            # the running uploader looks at the queue again before it stops
+            return
+        fcntl.flock(lock, fcntl.LOCK_UN)
+    subprocess.Popen([sys.executable, os.path.realpath(__file__), '--drain'],
+                     stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                     start_new_session=True)
+
+def queued(queue):
+    try:
+        return [name for name in os.listdir(queue) if not name.endswith('.tmp')]
+    except OSError:
+        return []
+
+def upload(queue, key):
+    # one queued entry, forgotten whether it went up or not
+    path = os.path.join(queue, key)
+    try:
+        with open(path) as f:
+            remote, timeout = f.read().split()
+        remote_put(remote, key, os.path.join(os.path.dirname(queue), key[:2], key[2:]), float(timeout))
+        state = 'uploads'
+    except (OSError, ValueError):
+        state = 'upload_errors'
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+    return state
+
+def take_lock(lock, deadline):
+    # tried once without a deadline, retried until it with one
+    while True:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except OSError:
+            if deadline is None or time.time() >= deadline:
+                return False
+            time.sleep(0.1)
+
+def drain(deadline=None):
+    # only the process holding the lock uploads, UPLOAD_JOBS at a time;
+    # without a deadline another one leaves, with one it waits for the
+    # lock and uploads until the deadline, leaving the rest queued
+    from concurrent.futures import ThreadPoolExecutor
+    folder = cache_dir()
+    queue = os.path.join(folder, 'uploads')
+    if not os.path.isdir(queue):
+        return 0
+    with open(os.path.join(folder, 'uploads.lock'), 'a') as lock:
+        while True:
+            if not take_lock(lock, deadline):
+                return 0
+            keys = queued(queue)
+            while keys:
+                if deadline is not None and time.time() >= deadline:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+                    return 0
+                batch, keys = keys[:UPLOAD_JOBS], keys[UPLOAD_JOBS:]
+                with ThreadPoolExecutor(max_workers=len(batch)) as workers:
+                    states = list(workers.map(lambda key: upload(queue, key), batch))
+                with locked_stats(folder) as stats:
+                    for state in states:
+                        stats[state] += 1
+                keys = keys or queued(queue)
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            # a wrapper may have queued an entry and seen the lock taken
+            # right before it was released
+            if not queued(queue):
+                return 0
+
+def compile_header(argv):
+    # precompiled headers aren't cached, only keyed for the compiles using
+    # them; -E reads the header itself, the -x stays
+    code = subprocess.call(argv)
+    args = argv[1:]
+    idx = args.index('-x')
+    parts = split_args(args[:idx] + args[idx + 2:])
+    key_file = parts[1] + '.key' if parts is not None else None
+    if code != 0 or key_file is None:
+        return code
+    source, output, rest = parts
+    key = cache_key(argv[0], source, output, args[idx:idx + 2] + rest)
+    if key is None:
+        if os.path.isfile(key_file):
+            os.remove(key_file)
+        return code
+    tmp = '{0}.{1}.tmp'.format(key_file, os.getpid())
+    with open(tmp, 'w') as out:
+        out.write(key)
+    os.replace(tmp, key_file)
+    return code
+
+def compile_cached(argv, max_size, remote=None, timeout=REMOTE_TIMEOUT):
+    compiler, args = argv[0], argv[1:]
+    if '-x' in args and args[args.index('-x') + 1:][:1] in (['c-header'], ['c++-header']):
+        return compile_header(argv)
+    folder = cache_dir()
+    parts = split_args(args)
+    key = None
+    if parts is not None:
+        os.makedirs(folder, exist_ok=True)
+        key = cache_key(compiler, *parts)
+    if key is None:
+        if os.path.isdir(folder):
+            with locked_stats(folder) as stats:
+                stats['uncacheable'] += 1
+        return subprocess.call(argv)
+    source, output, rest = parts
+    entry = os.path.join(folder, key[:2], key[2:])
+    dwo = os.path.splitext(output)[0] + '.dwo' if '-gsplit-dwarf' in rest else None
+    found = os.path.isfile(entry + '.o') and (dwo is None or os.path.isfile(entry + '.dwo'))
+    if not found and remote:
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        state, fetched = remote_get(remote, key, entry, ['.o'] if dwo is None else ['.o', '.dwo'], timeout)
+        with locked_stats(folder) as stats:
+            stats[state] += 1
+            stats['size'] += fetched
+        found = state == 'remote_hits'
+    if found:
+        try:
+            copy_atomic(entry + '.o', output)
+            os.utime(entry + '.o')
+            if dwo is not None:
+                copy_atomic(entry + '.dwo', dwo)
+                os.utime(entry + '.dwo')
+            with locked_stats(folder) as stats:
+                stats['hits'] += 1
+            return 0
+        except OSError:
+            pass
+    code = subprocess.call(argv)
+    if code != 0:
+        return code
+    os.makedirs(os.path.dirname(entry), exist_ok=True)
+    stored = 0
+    for built, suffix in [(output, '.o'), (dwo, '.dwo')]:
+        if built is not None and os.path.isfile(built):
+            copy_atomic(built, entry + suffix)
+            stored += os.path.getsize(built)
+    if remote:
+        upload_later(remote, key, timeout)
+    with locked_stats(folder) as stats:
+        stats['misses'] += 1
+        stats['size'] += stored
+        if stats['size'] > max_size:
+            stats['size'], removed = evict(folder, max_size)
+            stats['evicted'] += removed
+    return 0
+
+def show_stats():
+    folder = cache_dir()
+    if not os.path.isdir(folder):
+        print('-- no cache at', folder)
+        return 0
+    with locked_stats(folder) as stats:
+        lookups = stats['hits'] + stats['misses']
+        print('cache:      ', folder)
+        print('hits:       ', stats['hits'])
+        print('misses:     ', stats['misses'])
+        print('hit rate:    {0:.1f}%'.format(100.0 * stats['hits'] / lookups if lookups else 0.0))
+        print('uncacheable:', stats['uncacheable'])
+        print('evicted:    ', stats['evicted'])
+        print('size:        {0:.1f} MB'.format(stats['size'] / float(1 << 20)))
+        if stats['remote_hits'] + stats['remote_misses'] + stats['remote_errors'] + stats['uploads'] + stats['upload_errors']:
+            print('remote hits:  ', stats['remote_hits'])
+            print('remote misses:', stats['remote_misses'])
+            print('remote errors:', stats['remote_errors'])
+            print('uploads:      ', stats['uploads'])
+            print('upload errors:', stats['upload_errors'])
+    return 0
+
+def main(args):
+    # objcache.py [--max-size N] [--remote URL] -- <compiler> <args...>, or
+    # one of the maintenance options; SHURIKEN_REMOTE_CACHE names a remote
+    # for builds whose metal doesn't, like on CI runners; --flush returns
+    # once every queued upload is done or after SHURIKEN_FLUSH_TIMEOUT
+    # seconds
+    max_size = DEFAULT_MAX_SIZE
+    remote = os.environ.get('SHURIKEN_REMOTE_CACHE') or None
+    timeout = float(os.environ.get('SHURIKEN_REMOTE_TIMEOUT') or REMOTE_TIMEOUT)
+    usage = 'usage: objcache.py [--max-size SIZE] [--remote URL] [--remote-timeout SECONDS] -- COMPILER ARGS... | --stats | --zero | --clear | --flush'
+    while args and args[0].startswith('--'):
+        opt = args.pop(0)
+        if opt == '--':
+            break
+        if opt == '--max-size' and args:
+            max_size = parse_size(args.pop(0))
+        elif opt == '--remote' and args:
+            remote = args.pop(0)
+        elif opt == '--remote-timeout' and args:
+            timeout = float(args.pop(0))
+        elif opt == '--drain':
+            return drain()
+        elif opt == '--flush':
+            return drain(time.time() + float(os.environ.get('SHURIKEN_FLUSH_TIMEOUT') or FLUSH_TIMEOUT))
+        elif opt == '--stats':
+            return show_stats()
+        elif opt in ('--zero', '--clear'):
+            folder = cache_dir()
+            if os.path.isdir(folder):
+                with locked_stats(folder) as stats:
+                    stats.update((name, 0) for name in STATS if name != 'size')
+                    if opt == '--clear':
+                        for path in list(entries(folder)):
+                            os.remove(path)
+                        stats['size'] = 0
+            return 0
+        else:
+            print(usage)
+            return 2
+    if not args:
+        print(usage)
+        return 2
+    return compile_cached(args, max_size, remote, timeout)
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,159 @@
+import os
+import sys
+import json
+
+# reads ninja's build log of the last build and maps every output back to
+# the metal targets and sources through the graph written by shuriken
+
+def read_log(path):
+    # .ninja_log v5: start, end (ms), mtime, output, command hash; a build
+    # appends to it, so a finish time going backwards starts a new build
+    edges = {}
+    last_end = -1
+    with open(path) as log:
+        header = log.readline()
+        if not header.startswith('# ninja log v'):
+            print('-- not a ninja log:', path)
+            return []
+        for line in log:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) < 5:
+                continue
+            start, end = int(fields[0]), int(fields[1])
+            if end < last_end:
+                edges = {}
+            last_end = end
+            key = (start, end, fields[4])
+            edges.setdefault(key, []).append(fields[3])
+    result = []
+    for (start, end, cmdhash), outputs in edges.items():
+        result.append(dict(start=start, end=end, outputs=outputs))
+    result.sort(key=lambda e: (e['end'], e['start']))
+    return result
+
+def describe(output, graph):
+    node = graph.get(output)
+    if node is None:
+        return ''
+    parts = []
+    if node['targets']:
+        parts.append(', '.join(node['targets']))
+    if node['sources']:
+        sources = node['sources']
+        parts.append(sources[0] if len(sources) == 1 else '{0} +{1} more'.format(sources[0], len(sources) - 1))
+    if node.get('profile'):
+        parts.append('[{0}]'.format(node['profile']))
+    return ' '.join(parts)
+
+def critical_path(edges, graph):
+    # longest chain of edges, following the inputs recorded in the graph
+    by_output = {}
+    for edge in edges:
+        for output in edge['outputs']:
+            by_output[output] = edge
+    length = {}
+    previous = {}
+    for edge in edges:
+        best = None
+        for output in edge['outputs']:
+            for inp in graph.get(output, {}).get('inputs', []):
+                dep = by_output.get(inp)
+                if dep is not None and dep is not edge and id(dep) in length:
+                    if best is None or length[id(dep)] > length[id(best)]:
+                        best = dep
+        length[id(edge)] = edge['end'] - edge['start'] + (length[id(best)] if best else 0)
+        previous[id(edge)] = best
+    if not edges:
+        return 0, []
+    last = max(edges, key=lambda e: length[id(e)])
+    total = length[id(last)]
+    path = []
+    while last is not None:
+        path.append(last)
+        last = previous[id(last)]
+    path.reverse()
+    return total, path
+
+def chrome_trace(edges, graph):
+    # every edge on the first free lane, like ninja would have scheduled it
+    lanes = []
+    events = []
+    for edge in sorted(edges, key=lambda e: (e['start'], e['end'])):
+        for idx, busy_until in enumerate(lanes):
+            if busy_until <= edge['start']:
+                break
+        else:
+            idx = len(lanes)
+            lanes.append(0)
+        lanes[idx] = edge['end']
+        output = edge['outputs'][0]
+        node = graph.get(output, {})
+        events.append(dict(name=output, cat=node.get('rule', 'other'), ph='X', pid=0, tid=idx,
+                           ts=edge['start'] * 1000, dur=(edge['end'] - edge['start']) * 1000,
+                           args=dict(targets=node.get('targets', []), sources=node.get('sources', []))))
+    return dict(traceEvents=events, displayTimeUnit='ms')
+
+def seconds(ms):
+    return '{0:8.2f}s'.format(ms / 1000.0)
+
+def report(build_dir='ninja', graph_file=None, top=10, trace=None):
+    log_file = os.path.join(build_dir, '.ninja_log')
+    if not os.path.isfile(log_file):
+        print('-- no build log found at', log_file)
+        return 1
+    graph = {}
+    graph_file = graph_file or os.path.join(build_dir, 'shuriken.json')
+    try:
+        with open(graph_file) as f:
+            graph = json.load(f)
+    except (IOError, ValueError):
+        print('-- no shuriken graph at', graph_file, '(run shuriken first), outputs are shown unmapped')
+    edges = read_log(log_file)
+    if not edges:
+        print('-- nothing was built')
+        return 0
+
+    wall = max(e['end'] for e in edges) - min(e['start'] for e in edges)
+    busy = sum(e['end'] - e['start'] for e in edges)
+    print('edges: {0}  wall:{1}  cpu:{2}  parallelism: {3:.2f}x'.format(
+        len(edges), seconds(wall), seconds(busy), busy / float(wall) if wall else 1.0))
+
+    total, path = critical_path(edges, graph)
+    print('\ncritical path:{0}'.format(seconds(total)))
+    for edge in path:
+        print('  {0}  {1}  {2}'.format(seconds(edge['end'] - edge['start']), edge['outputs'][0], describe(edge['outputs'][0], graph)))
+
+    for title, rules in [('compiles', ('compile', 'pch')), ('links', ('link', 'archive'))]:
+        chosen = [e for e in edges if graph.get(e['outputs'][0], {}).get('rule') in rules]
+        chosen.sort(key=lambda e: e['start'] - e['end'])
+        if chosen:
+            print('\nslowest {0}:'.format(title))
+        for edge in chosen[:top]:
+            print('  {0}  {1}  {2}'.format(seconds(edge['end'] - edge['start']), edge['outputs'][0], describe(edge['outputs'][0], graph)))
+
+    per_target = {}
+    for edge in edges:
+        for target in graph.get(edge['outputs'][0], {}).get('targets', []):
+            per_target[target] = per_target.get(target, 0) + edge['end'] - edge['start']
+    if per_target:
+        print('\nper target (shared objects count for every target using them):')
+        for target, spent in sorted(per_target.items(), key=lambda t: -t[1]):
+            print('  {0}  {1}'.format(seconds(spent), target))
+
+    if trace:
+        with open(trace, 'w') as out:
+            json.dump(chrome_trace(edges, graph), out)
+        print('\ntrace written to', trace)
+    return 0
+
+def main(args):
+    import argparse
+    parser = argparse.ArgumentParser(prog='shuriken report', description='summarize the last ninja build')
+    parser.add_argument('-n', '--top', type=int, default=10, help='how many of the slowest compiles and links to show')
+    parser.add_argument('--trace', metavar='FILE', help='write a chrome trace_event json of the build')
+    parser.add_argument('--builddir', default='ninja', help='ninja builddir holding .ninja_log')
+    opts = parser.parse_args(args)
+    return report(opts.builddir, top=opts.top, trace=opts.trace)
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
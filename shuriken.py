@@ -1,118 +1,380 @@
 #!/usr/bin/env python3
 import sys
 import os
+import re
+import json
+import hashlib
 
-def gettem(patterns):
-    import glob
-    ll = set()
-    jj = set()
-    bla = patterns.split(' ')
-    for b in bla:
-        neg = False
-        if b.startswith('-'):
-            neg = True
-            b = b[1:]
-        #print(b, end=' ')
-        kk = set(glob.iglob(b))
-        #print(kk)
-        if neg:
-            jj = set(list(kk) + list(jj))
-        else:
-            ll = set(list(kk) + list(ll))
-    #print(ll - jj)
-    return ll - jj
-    pass
+STAMP_FILE = 'ninja/build.ninja.stamp'
+GRAPH_FILE = 'ninja/shuriken.json'
+COMPDB_FILE = 'compile_commands.json'
+# where outputs are written before replacing the old ones, out of every
+# folder a selector reads
+TMP_DIR = 'ninja/tmp'
+# the names in every folder build.ninja depends on, as ninja reads them
+LISTING_DIR = 'ninja/listings'
+# the generator itself: editing any of these regenerates build.ninja
+GENERATOR_FILES = ['shuriken.py', 'generate.py', 'objcache.py']
 
-def parse_lines(content):
+SKIPPED_DIRS = ['obj', 'bin', 'ninja']
+# written into the top folder by shuriken and ninja, not a change of its listing
+OWN_FILES = ['build.ninja', COMPDB_FILE, '.ninja_log', '.ninja_deps']
+# environment the generated manifest depends on besides its input files
+FINGERPRINT_ENV = ['PKG_CONFIG_PATH', 'PKG_CONFIG_LIBDIR', 'SHURIKEN_REMOTE_CACHE']
+PKG_CONFIG = os.environ.get('PKG_CONFIG', 'pkg-config')
+# 'linker fast' takes the first of these g++ can link with
+FAST_LINKERS = ['mold', 'lld', 'gold']
+# what g++ runs for -fuse-ld=<name>
+LINKER_PROGRAMS = {'mold': 'ld.mold', 'lld': 'ld.lld', 'gold': 'ld.gold'}
+LINK_POOL_DEPTH = 2
+
+def glob_to_regex(pattern):
+    # '*' and '?' stay inside one folder, '**/' crosses any number of them;
+    # like glob, wildcards don't match names starting with a dot
+    res = []
     idx = 0
-    # possible_tokens = ['info', 'path', 'compiler', 'linker', 'libs']
-    path = ''
-    compiler_flags = ''
-    linker_flags = ''
-    linker_libs = ''
-    if not content.endswith('\n'):
-        content = content + '\n'
-    # print(len(content), content)
-    while idx < len(content): # and content.startswith(possible_tokens, idx):
-        # print(idx, content[idx:idx+4], content.startswith('info', idx), path)
-        if content.startswith('info', idx):
-            while content[idx] != '"':
-                idx += 1
-            idx += 1
-            while content[idx] != '"':
-                idx += 1
-            while content[idx] != '\n':
-                idx += 1
-            idx += 1
-        elif content.startswith('path', idx):
-            path = (content[idx:].split(None, 1))[1].split('\n', 1)[0]
-            while content[idx] != '\n':
-                idx += 1
-            idx += 1
-        elif content.startswith('compiler', idx):
-            compiler_flags = (content[idx:].split(None, 1))[1].split('\n', 1)[0] + '  '
-            place = compiler_flags.find('$path$')
-            while place != -1:
-                compiler_flags = compiler_flags[:place] + path + compiler_flags[place+6:]
-                place = compiler_flags.find('$path$')
-
-            while content[idx] != '\n':
-                idx += 1
-            idx += 1
-        elif content.startswith('linker', idx):
-            linker_flags = (content[idx:].split(None, 1))[1].split('\n', 1)[0] + '  '
-            place = linker_flags.find('$path$')
-            # print('linkerflags', linker_flags)
-            # print('place', place)
-            # print('path', path)
-            # linker_flags = linker_flags[:place] + path + linker_flags[place+6:]
-            # place = linker_flags.find('$path$')
-            # print('linkerflags', linker_flags)
-            # print('place', place)
-            while place != -1:
-                linker_flags = linker_flags[:place] + path + linker_flags[place+6:]
-                place = linker_flags.find('$path$')
-
-            while content[idx] != '\n':
-                idx += 1
-            idx += 1
-        elif content.startswith('libs', idx):
-            linker_libs = (content[idx:].split(None, 1))[1].split('\n', 1)[0] + '  '
-            place = linker_libs.find('$path$')
-            while place != -1:
-                linker_libs = linker_libs[:place] + path + linker_libs[place+6:]
-                place = linker_libs.find('$path$')
-
-            while content[idx] != '\n':
-                idx += 1
-            idx += 1
+    start = True
+    while idx < len(pattern):
+        c = pattern[idx]
+        if pattern.startswith('**/', idx) and start:
+            res.append('(?:(?!\\.)[^/]+/)*')
+            idx += 3
+            continue
+        if pattern.startswith('**', idx) and start:
+            res.append('(?:(?!\\.)[^/]+(?:/(?!\\.)[^/]+)*)?')
+            idx += 2
+            continue
+        if c in '*?':
+            res.append(('(?!\\.)' if start else '') + ('[^/]*' if c == '*' else '[^/]'))
+        elif c == '[' and pattern.find(']', idx + 2) != -1:
+            end = pattern.find(']', idx + 2)
+            inner = pattern[idx + 1:end]
+            if inner.startswith('!'):
+                inner = '^' + inner[1:]
+            res.append(('(?!\\.)' if start else '') + '(?!/)[' + inner.replace('\\', '\\\\') + ']')
+            idx = end
         else:
-            idx += 1
-        pass
-    pass
-    compiler_flags = compiler_flags.strip()
-    linker_flags = linker_flags.strip()
-    linker_libs = linker_libs.strip()
-    return compiler_flags, linker_flags, linker_libs
+            res.append(re.escape(c))
+        start = c == '/'
+        idx += 1
+    return ''.join(res) + '\\Z'
 
-def parse_config(file):
-    with open(file, "r") as config:
-        content = config.read()
-        flags = parse_lines(content)
-        # print(flags)
+def compile_selector(selector):
+    import glob
+    negate = selector[:1] in ('-', '!')
+    if negate:
+        selector = selector[1:]
+    parts = selector.replace(os.sep, '/').split('/')
+    idx = 0
+    while idx < len(parts) - 1 and not glob.has_magic(parts[idx]):
+        idx += 1
+    base = '/'.join(parts[:idx])
+    if base == '' and idx > 0:
+        base = '/'
+    base = os.path.normpath(base) if base else '.'
+    rest = '/'.join(parts[idx:])
+    # how many folders down the pattern reaches, None for any with '**'
+    depth = None if '**' in rest else rest.count('/')
+    return negate, base.replace(os.sep, '/'), re.compile(glob_to_regex(rest)), depth
+
+class dir_index():
+    # every folder is read once per run with scandir, the selectors are then
+    # matched in memory against the cached listings
+    def __init__(self):
+        self.listings = {}
+        self.trees = {}
+        self.selectors = {}
+        # outputs of generate lines, selected whether they're written yet or not
+        self.outputs = []
+
+    def listing(self, folder):
+        if folder not in self.listings:
+            files = []
+            dirs = []
+            try:
+                with os.scandir(folder) as it:
+                    for entry in it:
+                        # like glob, a link to a folder is a folder
+                        if entry.is_dir():
+                            dirs.append(entry.name)
+                        else:
+                            files.append(entry.name)
+                self.listings[folder] = (files, dirs)
+            except OSError:
+                self.listings[folder] = None
+        return self.listings[folder] or ([], [])
+
+    def tree(self, folder, depth):
+        # paths of the files under folder, relative to it, at most depth
+        # folders down; a folder reached twice through links is read once
+        key = (folder, depth)
+        if key not in self.trees:
+            found = []
+            stack = [('', 0)]
+            seen = set()
+            while stack:
+                rel, level = stack.pop()
+                if not rel:
+                    path = folder
+                elif folder == '.':
+                    path = rel[:-1]
+                else:
+                    path = folder.rstrip('/') + '/' + rel[:-1]
+                if depth is None:
+                    real = os.path.realpath(path)
+                    if real in seen:
+                        continue
+                    seen.add(real)
+                files, dirs = self.listing(path)
+                found += (rel + name for name in files)
+                if depth is None or level < depth:
+                    # popped in name order, whatever order scandir gave: the
+                    # first path to a linked folder is the same everywhere
+                    for name in sorted(dirs, reverse=True):
+                        if name.startswith('.') or (folder == '.' and rel == '' and name in SKIPPED_DIRS):
+                            continue
+                        stack.append((rel + name + '/', level + 1))
+            self.trees[key] = found
+        return self.trees[key]
+
+    def select(self, selectors, generated_only=False):
+        added = set()
+        removed = set()
+        for sel in selectors:
+            if sel not in self.selectors:
+                self.selectors[sel] = compile_selector(sel)
+            negate, base, regex, depth = self.selectors[sel]
+            prefix = '' if base == '.' else base.rstrip('/') + '/'
+            found = removed if negate else added
+            if not generated_only:
+                found.update(prefix + rel for rel in self.tree(base, depth) if regex.match(rel))
+            found.update(path for path in self.outputs if path.startswith(prefix) and regex.match(path[len(prefix):]))
+        return sorted(added - removed)
+
+    def scanned_dirs(self):
+        return sorted(k for k, v in self.listings.items() if v is not None)
+
+    def forget(self, folder):
+        # files were added to or removed from folder
+        self.listings.pop(folder, None)
+        for base, depth in list(self.trees):
+            if reaches(base, folder, depth):
+                del self.trees[(base, depth)]
+
+    def reads(self, selector, folder):
+        if selector not in self.selectors:
+            self.selectors[selector] = compile_selector(selector)
+        negate, base, regex, depth = self.selectors[selector]
+        return reaches(base, folder, depth)
+
+def reaches(base, folder, depth=None):
+    # whether a walk from base, depth folders down, reads folder
+    if base == folder:
+        return True
+    if base == '.':
+        rel = folder
+    elif folder.startswith(base.rstrip('/') + '/'):
+        rel = folder[len(base.rstrip('/')) + 1:]
+    else:
+        return False
+    return depth is None or rel.count('/') < depth
+
+# one pass over the whole .cfg: a directive is the first word of a line, its
+# value is the rest of the line; info strings may span several lines
+CFG_TOKENS = re.compile(r'^[ \t]*(?:info[^"]*"[^"]*"[^\n]*|(path|compiler|linker|libs)\S*[ \t]*([^\n]*))', re.M)
+
+def parse_lines(content):
+    values = {'path': '', 'compiler': '', 'linker': '', 'libs': ''}
+    for match in CFG_TOKENS.finditer(content):
+        key, value = match.group(1, 2)
+        if key is None:
+            continue
+        value = value.strip()
+        if key != 'path':
+            value = value.replace('$path$', values['path'])
+        values[key] = value
+    return values['compiler'], values['linker'], values['libs']
+
+class config_cache():
+    # parsed .cfg files by path, reused while their mtime and size don't change
+    def __init__(self, filename):
+        self.filename = filename
+        self.dirty = False
+        try:
+            with open(filename) as f:
+                self.entries = json.load(f)
+        except (IOError, ValueError):
+            self.entries = {}
+
+    def get(self, path):
+        st = stat_entry(path)
+        entry = self.entries.get(path)
+        if entry is not None and entry[0] == st:
+            return tuple(entry[1])
+        with open(path, "r") as config:
+            flags = parse_lines(config.read())
+        self.entries[path] = [st, list(flags)]
+        self.dirty = True
         return flags
-        pass
-    pass
+
+    def save(self):
+        if not self.dirty:
+            return
+        tmp = self.filename + '.tmp'
+        try:
+            with open(tmp, 'w') as out:
+                json.dump(self.entries, out)
+            os.replace(tmp, self.filename)
+        except OSError:
+            pass
+        self.dirty = False
+
+class pkg_config_cache(config_cache):
+    # pkg-config answers by package, reused while PKG_CONFIG_PATH and the
+    # stat of every .pc file involved don't change
+    def get(self, name):
+        entry = self.entries.get(name)
+        if entry is None or entry['env'] != os.environ.get('PKG_CONFIG_PATH', ''):
+            return None
+        for pc, st in entry['pcs'].items():
+            if stat_entry(pc) != st:
+                return None
+        return tuple(entry['flags']), list(entry['pcs'])
+
+    def lookup(self, names):
+        # spawning pkg-config is the slow part, the misses run concurrently
+        missing = [name for name in set(names) if self.get(name) is None]
+        if not missing:
+            return
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=min(len(missing), 16)) as workers:
+            for name, entry in zip(missing, workers.map(query_pkg_config, missing)):
+                if entry is not None:
+                    self.entries[name] = entry
+                    self.dirty = True
+
+class linker_cache(config_cache):
+    # whether g++ links with -fuse-ld=<name>, asked again only when g++ or
+    # that linker changed
+    def get(self, name):
+        import shutil
+        key = [stat_entry(shutil.which('g++') or 'g++'), stat_entry(shutil.which(LINKER_PROGRAMS[name]) or name)]
+        entry = self.entries.get(name)
+        if entry is not None and entry[0] == key:
+            return entry[1]
+        works = try_linker(name)
+        self.entries[name] = [key, works]
+        self.dirty = True
+        return works
+
+def try_linker(name):
+    import subprocess
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp:
+        try:
+            proc = subprocess.run(['g++', '-fuse-ld=' + name, '-x', 'c++', '-', '-o', os.path.join(tmp, 'a.out')],
+                                  input='int main() { return 0; }\n', stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                                  universal_newlines=True)
+        except OSError:
+            return False
+    return proc.returncode == 0
+
+def run_pkg_config(args):
+    import subprocess
+    try:
+        proc = subprocess.run([PKG_CONFIG] + args, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True)
+    except OSError:
+        return None
+    return proc.stdout.strip() if proc.returncode == 0 else None
+
+def query_pkg_config(name):
+    # the flags split like a .cfg file and the .pc files they come from,
+    # the package's own and the ones of everything it requires
+    env = os.environ.get('PKG_CONFIG_PATH', '')
+    compiler = run_pkg_config(['--cflags', name])
+    if compiler is None:
+        return None
+    linker = run_pkg_config(['--libs-only-L', '--libs-only-other', name]) or ''
+    libs = run_pkg_config(['--libs-only-l', name]) or ''
+    packages = [name]
+    wanted = [name]
+    while wanted:
+        required = run_pkg_config(['--print-requires', '--print-requires-private'] + wanted) or ''
+        wanted = []
+        for req in required.splitlines():
+            req = req.split()
+            if req and req[0] not in packages:
+                packages.append(req[0])
+                wanted.append(req[0])
+    pcs = (run_pkg_config(['--path'] + packages) or '').splitlines()
+    return dict(env=env, pcs=dict((pc, stat_entry(pc)) for pc in pcs), flags=[compiler, linker, libs])
+
+_config_cache = None
+_pkg_config_cache = None
+_linker_cache = None
+_pkg_config_dirs = None
+
+def config_folder():
+    # next to the script unless SHURIKEN_CONFIG_DIR points somewhere else
+    return os.environ.get('SHURIKEN_CONFIG_DIR') or os.path.join(os.path.dirname(os.path.realpath(__file__)), 'config')
+
+def get_config_cache():
+    global _config_cache
+    if _config_cache is None:
+        _config_cache = config_cache(os.path.join(config_folder(), 'cache.json'))
+    return _config_cache
+
+def get_pkg_config_cache():
+    global _pkg_config_cache
+    if _pkg_config_cache is None:
+        _pkg_config_cache = pkg_config_cache(os.path.join(config_folder(), 'pkg-config.json'))
+    return _pkg_config_cache
+
+def get_linker_cache():
+    global _linker_cache
+    if _linker_cache is None:
+        _linker_cache = linker_cache(os.path.join(config_folder(), 'linkers.json'))
+    return _linker_cache
+
+def find_linker(wanted):
+    cache = get_linker_cache()
+    for name in FAST_LINKERS if wanted == 'fast' else [wanted]:
+        if cache.get(name):
+            return name
+    return None
+
+def parse_config(file):
+    return get_config_cache().get(file)
+
+def pkg_config_dirs():
+    # where pkg-config looks for .pc files, a package installed later
+    # lands in one of them
+    global _pkg_config_dirs
+    if _pkg_config_dirs is None:
+        default = os.environ.get('PKG_CONFIG_LIBDIR') or run_pkg_config(['--variable', 'pc_path', 'pkg-config']) or ''
+        paths = os.environ.get('PKG_CONFIG_PATH', '').split(os.pathsep) + default.split(os.pathsep)
+        _pkg_config_dirs = [p for p in dict.fromkeys(paths) if p and os.path.isdir(p)]
+    return _pkg_config_dirs
+
+def find_pkg_config(name):
+    # (compiler, linker, libs) and the .pc files read, None when pkg-config
+    # doesn't know the package either
+    cache = get_pkg_config_cache()
+    found = cache.get(name)
+    if found is None:
+        cache.lookup([name])
+        found = cache.get(name)
+    return found
 
 def get_config_files():
     # before = os.getcwd()
     # print(os.path.dirname(os.path.realpath(__file__)))
-    config_folder = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'config')
-    os.makedirs(config_folder, exist_ok=True)
+    folder = config_folder()
+    os.makedirs(folder, exist_ok=True)
     files = {}
-    for fl in os.listdir(config_folder):
+    for fl in os.listdir(folder):
         if fl.endswith('.cfg'):
-            files[fl[:-4]] = os.path.join(config_folder, fl)
+            files[fl[:-4]] = os.path.join(folder, fl)
         
     # print(files)
     return files
@@ -131,53 +393,373 @@ def get_config_files():
     # return compiler_flags, linker_flags, linker_libs
     pass
 
+def ninja_escape(path):
+    return path.replace('$', '$$').replace(' ', '$ ').replace(':', '$:')
+
+def listing_file(folder):
+    return os.path.join(LISTING_DIR, folder.replace('%', '%%').replace('/', '%') + '.txt')
+
+def write_listings(par):
+    # the same text the listing rule writes with ls, so ninja doesn't list
+    # a folder again right after a generation
+    own = par.own_names()
+    os.makedirs(LISTING_DIR, exist_ok=True)
+    for folder in [p for p in par.regen_inputs if os.path.isdir(p)]:
+        skipped = own.get(folder, ())
+        with open(listing_file(folder), 'w', newline='\n') as out:
+            out.write(''.join(name + '\n' for name in sorted(os.listdir(folder)) if name not in skipped))
+    # newer than every input even when no byte of it changed
+    os.utime('build.ninja')
+
+def stat_entry(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_mtime_ns, st.st_size]
+
+def generator_files():
+    here = os.path.dirname(os.path.realpath(__file__))
+    return [os.path.join(here, name) for name in GENERATOR_FILES]
+
+def listing_digest(folder, suffix='', skipped=()):
+    # the names in folder, the folders among them marked, leaving out the
+    # skipped ones: an output written there moves the folder mtime without
+    # changing what a selector finds
+    try:
+        with os.scandir(folder) as it:
+            names = sorted(entry.name + ('/' if entry.is_dir() else '') for entry in it)
+    except OSError:
+        return None
+    digest = hashlib.sha1()
+    for name in names:
+        if name.rstrip('/') not in skipped and name.endswith(suffix):
+            digest.update(name.encode(errors='surrogateescape') + b'\0')
+    return digest.hexdigest()
+
+def make_fingerprint(inputs, listings=()):
+    # inputs are files, listings are (folder, suffix, skipped names); the
+    # folder is stat before it's read, a change in between is seen next time
+    found = {}
+    for folder, suffix, skipped in listings:
+        st = stat_entry(folder)
+        found[folder] = [st, listing_digest(folder, suffix, skipped), suffix, sorted(skipped)]
+    return {'inputs': {p: stat_entry(p) for p in inputs}, 'listings': found,
+            'env': {v: os.environ.get(v, '') for v in FINGERPRINT_ENV}}
+
+def is_up_to_date(output, stamp):
+    # compares only stats, so a no-op run doesn't glob or parse anything;
+    # a folder whose mtime moved is read again, alone, and only a changed
+    # listing counts
+    if not os.path.isfile(output):
+        return False
+    try:
+        with open(stamp) as f:
+            old = json.load(f)
+    except (IOError, ValueError):
+        return False
+    if old.get('env') != {v: os.environ.get(v, '') for v in FINGERPRINT_ENV}:
+        return False
+    for path, st in old.get('inputs', {}).items():
+        if stat_entry(path) != st:
+            return False
+    moved = False
+    for folder, entry in old.get('listings', {}).items():
+        st = stat_entry(folder)
+        if st == entry[0]:
+            continue
+        if st is None or listing_digest(folder, entry[2], set(entry[3])) != entry[1]:
+            return False
+        entry[0] = st
+        moved = True
+    if moved:
+        # so the next run doesn't read those folders again
+        with open(stamp, 'w') as f:
+            json.dump(old, f)
+    return True
+
+def same_content(first, second):
+    try:
+        if os.path.getsize(first) != os.path.getsize(second):
+            return False
+        with open(first, 'rb') as a, open(second, 'rb') as b:
+            while True:
+                chunk = a.read(1 << 16)
+                if chunk != b.read(1 << 16):
+                    return False
+                if not chunk:
+                    return True
+    except OSError:
+        return False
+
+def object_path(source, obj_ext, variant=None, obj_dir='obj/'):
+    # sources compiled with more than one set of flags get one object per
+    # set, told apart by a hash of the flags
+    local = source
+    while local.startswith('../'):
+        local = local[3:]
+    if variant is not None:
+        local += '.' + hashlib.sha1(variant.encode()).hexdigest()[:8]
+    if local.startswith('obj/'):
+        # generated by shuriken itself, already inside obj/
+        local = local[4:]
+    return obj_dir + local + obj_ext
+
+def in_folder(path, folder):
+    # a path of the metal file in folder, seen from the top metal file
+    if not folder:
+        return path
+    return os.path.normpath(os.path.join(folder, path)).replace(os.sep, '/')
+
+def selector_in_folder(selector, folder):
+    sign = selector[:1] if selector[:1] in ('-', '!') else ''
+    return sign + in_folder(selector[len(sign):], folder)
+
+PROFILES = {
+    'debug': dict(flags=['-g', '-ggdb']),
+    'release': dict(flags=['-O2', '-DNDEBUG']),
+    'relwithdebinfo': dict(flags=['-O2', '-g', '-DNDEBUG']),
+    'native': dict(flags=['-O3', '-march=native', '-DNDEBUG']),
+}
+
+PROFILE_OPTIONS = {
+    'lto': dict(flags=['-flto'], ld=['-flto']),
+    'gc-sections': dict(flags=['-ffunction-sections', '-fdata-sections'], ld=['-Wl,--gc-sections']),
+}
+
+def make_profile(name, options):
+    # name None is the single default profile, building debug into obj/
+    flags = list(PROFILES[name or 'debug']['flags'])
+    ld = []
+    for opt in options:
+        flags += PROFILE_OPTIONS[opt]['flags']
+        ld += PROFILE_OPTIONS[opt]['ld']
+    return dict(name=name, c=flags, cpp=flags, ld=ld, lto='lto' in options,
+                obj_dir='obj/{0}/'.format(name) if name else 'obj/',
+                out_dir='bin/{0}/'.format(name) if name else '',
+                only=None, pgo=None, train=None, split=False)
+
+def make_pgo_profiles(target, base, train):
+    # an instrumented build that the training command runs, then the
+    # optimized build using the .gcda files it left next to the objects
+    gen = make_profile(base, [])
+    gen.update(name='pgo-gen-' + target, only=target, pgo='gen', train=train,
+               obj_dir='obj/pgo-gen/{0}/'.format(target), out_dir='bin/pgo-gen/{0}/'.format(target))
+    gen['c'] = gen['cpp'] = gen['c'] + ['-fprofile-generate']
+    gen['ld'] = gen['ld'] + ['-fprofile-generate']
+    use = make_profile(base, [])
+    use.update(name='pgo-' + target, only=target, pgo='use',
+               obj_dir='obj/pgo/{0}/'.format(target), out_dir='bin/pgo/{0}/'.format(target))
+    use['c'] = use['cpp'] = use['c'] + ['-fprofile-use', '-fprofile-partial-training', '-Wno-missing-profile']
+    return [gen, use]
+
+class atomic_writer():
+    # streams into a temporary file under TMP_DIR and only replaces path
+    # when the bytes differ, so an unchanged output keeps its mtime and an
+    # interrupted run never leaves a half written file behind; the
+    # temporary file stays out of the folders the stamp lists
+    def __init__(self, path):
+        self.path = path
+        self.tmp = os.path.join(TMP_DIR, path.replace('%', '%%').replace('/', '%') + '.tmp')
+        self.changed = False
+
+    def __enter__(self):
+        os.makedirs(TMP_DIR, exist_ok=True)
+        self.out = open(self.tmp, 'w', buffering=1 << 16, newline='\n')
+        return self.out
+
+    def __exit__(self, kind, value, traceback):
+        self.out.close()
+        if kind is not None or same_content(self.tmp, self.path):
+            os.remove(self.tmp)
+        else:
+            os.replace(self.tmp, self.path)
+            # the rename moved the folder mtime past the file's, ninja would
+            # take the folder as a newer input of build.ninja
+            os.utime(self.path)
+            self.changed = True
+        return False
+
+class SourceFile():
+    # one per path, shared by every target selecting it
+    __slots__ = ('path', 'lang')
+
+    def __init__(self, path):
+        self.path = path
+        self.lang = os.path.splitext(path)[1]
+
+class Library():
+    # a configlib, from a .cfg file or from pkg-config
+    __slots__ = ('name', 'compiler', 'linker', 'libs')
+
+    def __init__(self, name, compiler='', linker='', libs=''):
+        self.name = name
+        self.compiler = sys.intern(compiler)
+        self.linker = sys.intern(linker)
+        self.libs = sys.intern(libs)
+
+class Target():
+    # an exec or a lib, a test is an exec run by 'shuriken test'; the flags
+    # are interned, most targets have the same
+    __slots__ = ('kind', 'name', 'sources', 'selectors', 'using', 'archives', 'compiler_f',
+                 'linker_f', 'linker_libs', 'c_only', 'cpp_only', 'c_disabled', 'cpp_disabled', 'thin', 'test')
+
+    def __init__(self, kind, name, sources, selectors=()):
+        self.kind = kind
+        self.name = name
+        self.sources = sources
+        self.selectors = list(selectors)
+        # (line number, line, name) of the libs still to link
+        self.using = []
+        self.archives = []
+        self.compiler_f = ''
+        self.linker_f = ''
+        self.linker_libs = ''
+        self.c_only = ''
+        self.cpp_only = ''
+        # profile flags a disable line took out
+        self.c_disabled = frozenset()
+        self.cpp_disabled = frozenset()
+        self.thin = False
+        self.test = False
+
+    @property
+    def build_files(self):
+        return [source.path for source in self.sources]
+
+    def copy(self):
+        # linking the libs changes the lists, the rest is shared
+        clone = Target.__new__(Target)
+        for slot in Target.__slots__:
+            value = getattr(self, slot)
+            setattr(clone, slot, list(value) if isinstance(value, list) else value)
+        return clone
+
+class Project():
+    # execs, libs and configlibs by name and sources by path; the metal
+    # parser fills one, python code can fill one too and get its manifest
+    # without any file being read or written:
+    #   project = Project()
+    #   project.add_configlib('m', libs='-lm')
+    #   project.add_lib('core', ['core/a.cpp'], thin=True)
+    #   project.add_exec('app', ['app/main.cpp'], using=['core', 'm'])
+    #   text = project.ninja()
+    __slots__ = ('execs', 'libraries', 'configlibs', 'sources')
+
+    def __init__(self):
+        self.execs = dict()
+        self.libraries = dict()
+        self.configlibs = dict()
+        self.sources = dict()
+
+    def source(self, path):
+        found = self.sources.get(path)
+        if found is None:
+            found = self.sources[path] = SourceFile(sys.intern(path))
+        return found
+
+    def add_configlib(self, name, compiler='', linker='', libs=''):
+        self.configlibs[name] = Library(name, compiler, linker, libs)
+        return self.configlibs[name]
+
+    def add_exec(self, name, sources, using=(), flags=None):
+        return self.add_target('exec', name, sources, using, flags=flags)
+
+    def add_test(self, name, sources, using=(), flags=None):
+        target = self.add_target('exec', name, sources, using, flags=flags)
+        target.test = True
+        return target
+
+    def add_lib(self, name, sources, using=(), thin=False, flags=None):
+        target = self.add_target('lib', name, sources, using, flags=flags)
+        target.thin = thin
+        return target
+
+    def add_target(self, kind, name, sources, using=(), selectors=(), flags=None, number=None, line='', disabled=None):
+        # configlibs are applied right away, libs can be declared later and
+        # are linked once the whole project is known
+        target = Target(kind, name, [self.source(path) for path in sources], selectors)
+        found = []
+        for lib in using:
+            if lib in self.configlibs:
+                found.append(self.configlibs[lib])
+            else:
+                target.using.append((number, line, lib))
+        target.compiler_f = sys.intern(' '.join(lib.compiler for lib in found if lib.compiler))
+        target.linker_f = sys.intern(' '.join(lib.linker for lib in found if lib.linker))
+        target.linker_libs = sys.intern(' '.join(lib.libs for lib in found if lib.libs))
+        flags = flags or metal_parser.default_flags
+        target.c_only = sys.intern(' '.join(flags['c']).strip() + ' ')
+        target.cpp_only = sys.intern(' '.join(flags['cpp']).strip() + ' ')
+        if disabled:
+            target.c_disabled = frozenset(disabled['c'])
+            target.cpp_disabled = frozenset(disabled['cpp'])
+        (self.libraries if kind == 'lib' else self.execs)[name] = target
+        return target
+
+    def copy(self):
+        clone = Project()
+        clone.execs = dict((name, target.copy()) for name, target in self.execs.items())
+        clone.libraries = dict((name, target.copy()) for name, target in self.libraries.items())
+        clone.configlibs = dict(self.configlibs)
+        clone.sources = dict(self.sources)
+        return clone
+
+    def ninja(self):
+        # generated from a copy, the project can still be changed and
+        # generated again; KeyError for a lib nobody declared, ValueError
+        # for a lib using itself
+        import io
+        out = io.StringIO()
+        metal_parser(self.copy()).gen_ninja(out)
+        return out.getvalue()
+
 class metal_parser():
     default_flags = dict()
-    default_flags['cpp'] = '-std=c++17 -pedantic -pedantic-errors -Wall -Wextra -g -ggdb -Wcast-align -Wcast-qual -Wctor-dtor-privacy -Wdisabled-optimization -Wformat=2 -Wmissing-declarations -Wmissing-include-dirs -Wold-style-cast -Woverloaded-virtual -Wredundant-decls -Wshadow -Wsign-conversion -Wsign-promo -Wstrict-overflow=5 -Wswitch-default -Wundef -Werror'.split(' ')
+    default_flags['cpp'] = '-std=c++17 -pedantic -pedantic-errors -Wall -Wextra -Wcast-align -Wcast-qual -Wctor-dtor-privacy -Wdisabled-optimization -Wformat=2 -Wmissing-declarations -Wmissing-include-dirs -Wold-style-cast -Woverloaded-virtual -Wredundant-decls -Wshadow -Wsign-conversion -Wsign-promo -Wstrict-overflow=5 -Wswitch-default -Wundef -Werror'.split(' ')
     default_flags['c'] = '-Wall -Wextra -Wformat-nonliteral -Wcast-align -Wpointer-arith -Wbad-function-cast -Wmissing-prototypes -Wmissing-declarations -Winline -Wundef -Wnested-externs -Wcast-qual -Wshadow -Wwrite-strings -Wfloat-equal -pedantic -std=c99'.split(' ')
     selected_flags = default_flags.copy()
-    compiler_f = {}
-    linker_f = {}
-    libs = {}
-    found_libs = []
 
     execs = {}
     # found_configs = {}
-    def __init__(self):
-    	self.execs = dict()
-    	self.libs = dict()
-    	self.linker_f = dict()
-    	self.compiler_f = dict()
+    def __init__(self, project=None):
+    	self.project = project or Project()
+    	self.execs = self.project.execs
+    	self.libraries = self.project.libraries
+    	self.pchs = list()
+    	self.unity = dict()
+    	self.generated = list()
+    	self.generates = list()
+    	self.profiles = list()
+    	self.pgo = list()
+    	self.pools = dict()
+    	self.unity_members = dict()
+    	self.used_configs = list()
+    	# folders whose listing decides what a configlib found, by the
+    	# suffix of the names that count
+    	self.listed_folders = dict()
+    	self.index = dir_index()
+    	self.regen_inputs = list()
+    	self.subdirs = list()
+    	self.subdir_inputs = list()
+    	# outputs of the generate lines of the metal files including this
+    	# one, seen from the top
+    	self.inherited_outputs = list()
+    	self.linker = None
+    	self.debug = list()
+    	self.cache = None
+    	self.cache_remote = None
+    	# per parser, a worker parsing several subdirs mustn't mix them up
+    	self.selected_flags = dict((lang, list(flags)) for lang, flags in self.default_flags.items())
+    	self.disabled_flags = dict((lang, list()) for lang in self.default_flags)
 
     def set_found_configs(self, found_cfgs):
         self.found_configs = found_cfgs.copy()
         # print(self.found_configs)
         return
 
-    def matches(self, files, selectors):
-        result = gettem(' '.join(selectors))
-        aa = []
-        for fil in result:
-            fil = os.path.relpath(fil, '.')
-            aa.append(fil)
-            # print(file)
-            #accept = False
-            # discarted = False
-            # for sel in selectors:
-            #     negate = sel.startswith('-')
-            #     if negate:
-            #         sel = sel[1:]
-            #     if not fnmatch.fnmatch(file, sel):
-            #         continue
-            #     if negate:
-            #         discarted = True
-            #     accept = not negate
-            # if accept and not discarted:
-            #     result.append(file)
-        aa.sort()
-        # print(result)
-        return aa
-        pass
+    def matches(self, selectors):
+        return self.index.select(selectors)
 
     def line_exec(self, number, tokens, line):
         if len(tokens) == 0:
@@ -185,47 +767,237 @@ class metal_parser():
             print('not enough arguments')
             return
         name = tokens[0]
-        selectors = []
-        libraries = []
         if name == '.':
             name = os.path.split(os.getcwd())[1]
             pass
+        self.target_pack('exec', name, number, tokens[1:], line)
+        return
+        pass
+
+    def line_test(self, number, tokens, line):
+        # an exec that 'shuriken test' runs
+        if len(tokens) == 0:
+            print('syntax error at line', number)
+            print('not enough arguments')
+            return
+        name = tokens[0]
+        if name == '.':
+            name = os.path.split(os.getcwd())[1]
+        self.target_pack('exec', name, number, tokens[1:], line).test = True
+        return
+
+    def line_lib(self, number, tokens, line):
+        if len(tokens) == 0:
+            print('syntax error at line', number)
+            print('not enough arguments')
+            return
+        name = tokens[0]
+        thin = len(tokens) > 1 and tokens[1] == 'thin'
+        self.target_pack('lib', name, number, tokens[2 if thin else 1:], line).thin = thin
+        return
+
+    def line_pch(self, number, tokens, line):
+        if len(tokens) == 0 or tokens[1:2] not in ([], ['for']):
+            print('syntax error at line', number)
+            print('expected: pch <header> [for <targets or selectors>]')
+            return
+        if len(tokens) == 2:
+            print('syntax error at line', number)
+            print('nothing after for')
+            return
+        header = os.path.normpath(tokens[0]).replace(os.sep, '/')
+        self.pchs.append((header, tokens[2:], ''))
+        return
+
+    def line_profile(self, number, tokens, line):
+        if len(tokens) == 0:
+            print('syntax error at line', number)
+            print('not enough arguments')
+            return
+        name = tokens[0]
+        if name not in PROFILES:
+            print('error at line', number)
+            print('unknown profile', name, '(known: {0})'.format(', '.join(sorted(PROFILES))))
+            return
+        for opt in tokens[1:]:
+            if opt not in PROFILE_OPTIONS:
+                print('error at line', number)
+                print('unknown profile option', opt)
+                print('note:', line)
+                print(' ' * (line.find(opt) + 6) + '^' * len(opt))
+                return
+        if name in (p['name'] for p in self.profiles):
+            print('error at line', number)
+            print('profile', name, 'declared twice')
+            return
+        self.profiles.append(make_profile(name, tokens[1:]))
+        return
+
+    def line_pgo(self, number, tokens, line):
+        if len(tokens) < 3 or 'run' not in tokens[1:3]:
+            print('syntax error at line', number)
+            print('expected: pgo <exec> [base profile] run <training command>')
+            return
+        target = tokens[0]
+        start = tokens.index('run')
+        base = tokens[1] if start == 2 else 'release'
+        if base not in PROFILES:
+            print('error at line', number)
+            print('unknown profile', base, '(known: {0})'.format(', '.join(sorted(PROFILES))))
+            return
+        train = line.split(None, start + 2)[-1] if len(tokens) > start + 1 else ''
+        if not train:
+            print('syntax error at line', number)
+            print('missing training command')
+            return
+        self.pgo.append((number, target, base, train))
+        return
+
+    def line_generate(self, number, tokens, line):
+        if 'run' not in tokens or tokens[0] in ('run', 'from') or tokens[-1] == 'run':
+            print('syntax error at line', number)
+            print('expected: generate <outputs> [from <inputs>] run <command>')
+            return
+        start = tokens.index('run')
+        outputs = tokens[:start]
+        selectors = []
+        if 'from' in outputs:
+            selectors = outputs[outputs.index('from') + 1:]
+            outputs = outputs[:outputs.index('from')]
+        outputs = [os.path.normpath(path).replace(os.sep, '/') for path in outputs]
+        for path in outputs:
+            if re.search(r'[*?[]', path):
+                print('error at line', number)
+                print('generated outputs are paths, not selectors:', path)
+                return
+            if path in self.index.outputs:
+                print('error at line', number)
+                print(path, 'is already generated by another line')
+                return
+        # plain paths can be outputs of other generate lines, not written yet
+        inputs = [os.path.normpath(sel).replace(os.sep, '/') for sel in selectors if not re.search(r'[*?[]', sel) and sel[:1] not in ('-', '!')]
+        globs = [sel for sel in selectors if sel not in inputs]
+        if globs:
+            inputs += [path for path in self.matches(globs) if path not in inputs]
+        # $in$, $out$ and $dir$ (the folder of this metal file) in the
+        # command, which runs in the top folder
+        command = line.split(None, start + 2)[-1]
+        self.index.outputs += outputs
+        self.generates.append((outputs, inputs, command, ''))
+        return
+
+    def line_pool(self, number, tokens, line):
+        if len(tokens) < 2 or not tokens[1].isdigit() or tokens[2:3] not in ([], ['for']):
+            print('syntax error at line', number)
+            print('expected: pool <name> <depth> [for <selectors>]')
+            return
+        name = tokens[0]
+        if name == 'console':
+            print('error at line', number)
+            print('console is a pool of ninja itself')
+            return
+        if int(tokens[1]) < 1:
+            print('error at line', number)
+            print('pool depth must be at least 1')
+            return
+        self.pools[name] = (int(tokens[1]), tokens[3:])
+        return
+
+    def line_unity(self, number, tokens, line):
+        if len(tokens) == 0:
+            print('syntax error at line', number)
+            print('expected: unity <target> [batch size] [except <selectors>]')
+            return
+        name = tokens[0]
+        rest = tokens[1:]
+        size = 8
+        if rest and rest[0].isdigit():
+            size = int(rest[0])
+            rest = rest[1:]
+        if size < 1:
+            print('error at line', number)
+            print('unity batch size must be at least 1')
+            return
+        if rest and rest[0] != 'except':
+            print('syntax error at line', number)
+            print('expected except, found', rest[0])
+            return
+        self.unity[name] = (size, rest[1:])
+        return
+
+    def target_pack(self, kind, name, number, tokens, line):
+        selectors = []
+        libraries = []
         if 'using' not in tokens:
-            selectors = tokens[1:]
+            selectors = tokens
         else:
             start = tokens.index('using')
-            selectors = tokens[1:start]
+            selectors = tokens[:start]
             libraries = tokens[start + 1:]
 
-        files = os.listdir()
-        # print(files)
-        build_files = self.matches(files, selectors)
+        build_files = self.matches(selectors)
         # print(build_files)
+        return self.project.add_target(kind, name, build_files, libraries, selectors, self.selected_flags, number, line, self.disabled_flags)
 
-        compiler_flags = ''
-        linker_flags = ''
-        linker_libs = ''
-        for lib in libraries:
-            if lib not in self.found_libs:
+    def line_linker(self, number, tokens, line):
+        if len(tokens) != 1 or tokens[0] not in FAST_LINKERS + ['fast']:
+            print('syntax error at line', number)
+            print('expected: linker <fast, {0}>'.format(', '.join(FAST_LINKERS)))
+            return
+        self.linker = tokens[0]
+        return
+
+    def line_debug(self, number, tokens, line):
+        if len(tokens) == 0:
+            print('syntax error at line', number)
+            print('expected: debug [split] [compressed]')
+            return
+        for opt in tokens:
+            if opt not in ['split', 'compressed']:
                 print('error at line', number)
-                print('not declared library', lib)
+                print('unknown debug option', opt)
                 print('note:', line)
-                print(' ' * (line.find(lib) + 6) + '^' * len(lib))
+                print(' ' * (line.find(opt) + 6) + '^' * len(opt))
+                return
+        self.debug = tokens
+        return
+
+    def line_cache(self, number, tokens, line):
+        size = '5G'
+        remote = None
+        if tokens and tokens[0] != 'remote':
+            size = tokens.pop(0)
+        if tokens and tokens[0] == 'remote' and len(tokens) == 2:
+            remote = tokens[1]
+            tokens = []
+        if tokens or not re.match(r'^\d+(\.\d+)?[KMGT]?$', size, re.I) or (remote and not re.match(r'^https?://', remote)):
+            print('syntax error at line', number)
+            print('expected: cache [max size, like 500M or 5G] [remote http://host:port]')
+            return
+        self.cache = size
+        self.cache_remote = remote
+        return
+
+    def line_subdir(self, number, tokens, line):
+        if len(tokens) == 0:
+            print('syntax error at line', number)
+            print('not enough arguments')
+            return
+        for folder in tokens:
+            folder = os.path.normpath(folder).replace(os.sep, '/')
+            if folder == '.':
+                print('error at line', number)
+                print('a metal file can not include itself')
+                continue
+            if not os.path.isdir(folder):
+                print('error at line', number)
+                print('no folder named', folder)
+                print('note:', line)
+                print(' ' * (line.find(folder) + 6) + '^' * len(folder))
                 continue
-            # print('adding library', lib, 'to', name)
-            compiler_flags += ' ' + self.compiler_f[lib]
-            linker_flags += ' ' + self.linker_f[lib]
-            linker_libs += ' ' + self.libs[lib]
-
-        # print(self.compiler_f, self.linker_f, self.libs)
-        self.execs[name] = {'build_files': build_files}
-        self.execs[name]['compiler_f'] = compiler_flags.strip()
-        self.execs[name]['linker_f'] = linker_flags.strip()
-        self.execs[name]['linker_libs'] = linker_libs.strip()
-        self.execs[name]['c_only'] = ' '.join(self.selected_flags['c']).strip() + ' '
-        self.execs[name]['cpp_only'] = ' '.join(self.selected_flags['cpp']).strip() + ' '
+            if folder not in self.subdirs:
+                self.subdirs.append(folder)
         return
-        pass
 
     def line_configlib(self, number, tokens, line):
         if len(tokens) == 0:
@@ -238,13 +1010,23 @@ class metal_parser():
             return
         lib = tokens[0]
         if self.found_configs.get(lib, False) == False:
-            print('error at line', number)
-            print("couldn't find the wanted library")
-            print('note:', line)
-            print(' ' * (line.find(lib) + 6) + '^' * len(lib))
+            # no .cfg file for it, maybe pkg-config knows it; adding the
+            # .cfg or installing the package later changes the answer
+            self.listed_folders[config_folder()] = '.cfg'
+            found = find_pkg_config(lib)
+            if found is None:
+                self.listed_folders.update((folder, '.pc') for folder in pkg_config_dirs())
+                print('error at line', number)
+                print("couldn't find the wanted library")
+                print('note:', line)
+                print(' ' * (line.find(lib) + 6) + '^' * len(lib))
+                return
+            flags, pcs = found
+            self.project.add_configlib(lib, *flags)
+            self.used_configs += [pc for pc in pcs if pc not in self.used_configs]
             return
-        self.compiler_f[lib], self.linker_f[lib], self.libs[lib] = parse_config(self.found_configs[lib])
-        self.found_libs.append(lib)
+        self.project.add_configlib(lib, *parse_config(self.found_configs[lib]))
+        self.used_configs.append(self.found_configs[lib])
         return
         pass
 
@@ -259,24 +1041,42 @@ class metal_parser():
             return
         language = tokens[0]
         options = tokens[1:]
+        # the debug flags come from the profile, not from the selected ones
+        in_profiles = set(f for p in list(PROFILES.values()) + list(PROFILE_OPTIONS.values()) for f in p['flags'])
         for opt in options:
             if opt in self.selected_flags[language]:
                 self.selected_flags[language].remove(opt)
-                pass
-            pass
+            elif opt in in_profiles:
+                if opt not in self.disabled_flags[language]:
+                    self.disabled_flags[language].append(opt)
+            else:
+                print('error at line', number)
+                print(opt, 'is not a', language, 'flag in use')
+                print('note:', line)
+                print(' ' * (line.find(opt) + 6) + '^' * len(opt))
         pass
 
+    def metal_lines(self, lines):
+        # the packages missing a .cfg are asked to pkg-config all at once
+        # before the lines needing them are parsed
+        wanted = []
+        for line in lines:
+            tokens = line.split()
+            if tokens[:1] == ['configlib'] and len(tokens) == 2 and tokens[1] not in self.found_configs:
+                wanted.append(tokens[1])
+        if wanted:
+            get_pkg_config_cache().lookup(wanted)
+        for number, line in enumerate(lines):
+            self.metal_line(number, line)
+
     def metal_line(self, number, line):
         if line.endswith('\n'):
             line = line[:-1]
-        tokens = line.split(' ')
-        if tokens[0].startswith('#') or len(tokens) == 0:
+        tokens = line.split()
+        if len(tokens) == 0 or tokens[0].startswith('#'):
             return
-        idx = 0
-        for idx, token in enumerate(tokens):
-            tokens[idx] = token.strip()
         # print(tokens)
-        if tokens[0] in ['exec', 'configlib', 'section', 'disable']:
+        if tokens[0] in ['exec', 'test', 'lib', 'generate', 'pch', 'unity', 'profile', 'pgo', 'pool', 'linker', 'debug', 'cache', 'subdir', 'configlib', 'section', 'disable']:
             if hasattr(self, 'line_' + tokens[0]):
                 getattr(self, 'line_' + tokens[0])(number, tokens[1:], line)
                 # print('executed', 'line_' + tokens[0])
@@ -407,112 +1207,753 @@ class metal_parser():
         # #         print("syntax error")
         # #     curr_section = ''
         # # pass
-    def gen_ninja(self):
+    def resolve_libs(self):
+        # a target can use the libs of every metal file in the project, so
+        # they are only linked once all of them were parsed
+        for name, pack in self.libraries.items():
+            self.link_libs(pack, [name])
+        for pack in self.execs.values():
+            self.link_libs(pack, [])
+
+    def link_libs(self, pack, chain):
+        using, pack.using = pack.using, []
+        for number, line, lib in using:
+            if lib not in self.libraries and number is None:
+                # added from python, there's no metal line to show
+                raise KeyError('{0} {1} uses {2}, which is not a declared lib nor configlib'.format(pack.kind, pack.name, lib))
+            if lib in chain and number is None:
+                raise ValueError('lib {0} uses itself: {1}'.format(lib, ' -> '.join(chain + [lib])))
+            if lib not in self.libraries:
+                print('error at line', number)
+                print('not declared library', lib)
+                print('note:', line)
+                print(' ' * (line.find(lib) + 6) + '^' * len(lib))
+                continue
+            if lib in chain:
+                print('error at line', number)
+                print('library', lib, 'uses itself:', ' -> '.join(chain + [lib]))
+                continue
+            needed = self.libraries[lib]
+            self.link_libs(needed, chain + [lib])
+            # its archive and whatever it needs
+            pack.archives += [a for a in needed.archives if a not in pack.archives]
+            pack.archives.append(lib)
+            pack.linker_f = sys.intern(' '.join(f for f in [pack.linker_f, needed.linker_f] if f))
+            pack.linker_libs = sys.intern(' '.join(f for f in [pack.linker_libs, needed.linker_libs] if f))
+
+    def collect_regen_inputs(self, metal):
+        # a subdir folder can be read by the top selectors too; shuriken's
+        # own files stand for its version
+        inputs = [metal] + self.used_configs + list(self.listed_folders) + self.index.scanned_dirs() + self.subdir_inputs
+        inputs += generator_files()
+        self.regen_inputs = list(dict.fromkeys(inputs))
+
+    def own_names(self):
+        # by folder, the names shuriken and ninja write into it
+        own = {'.': set(OWN_FILES)}
+        for path in list(self.graph) + self.generated:
+            folder, name = os.path.split(path)
+            own.setdefault(folder or '.', set()).add(name)
+        for path in self.regen_inputs:
+            if os.path.basename(path) == 'metal':
+                # every metal folder skips them like the top one
+                own.setdefault(os.path.dirname(path) or '.', set()).update(SKIPPED_DIRS)
+        return own
+
+    def refresh_folder(self, folder):
+        # only the targets with a selector reading folder are selected
+        # again, True when one of them changed
+        self.index.forget(folder)
+        changed = False
+        for pack in list(self.execs.values()) + list(self.libraries.values()):
+            if any(self.index.reads(sel, folder) for sel in pack.selectors):
+                build_files = self.matches(pack.selectors)
+                if build_files != pack.build_files:
+                    pack.sources = [self.project.source(f) for f in build_files]
+                    changed = True
+        return changed
+
+    def inherited(self):
+        # what the metal file of a subdir gets from the one including it
+        outputs = self.inherited_outputs + [path for outputs, _, _, _ in self.generates for path in outputs]
+        return dict(configlibs=self.project.configlibs, selected_flags=self.selected_flags, disabled_flags=self.disabled_flags,
+                    outputs=outputs)
+
+    def inherit(self, inherited, folder=''):
+        self.project.configlibs.update(inherited['configlibs'])
+        self.selected_flags = dict((lang, list(flags)) for lang, flags in inherited['selected_flags'].items())
+        self.disabled_flags = dict((lang, list(flags)) for lang, flags in inherited['disabled_flags'].items())
+        # not written yet on a clean tree, selected like the outputs of
+        # the generate lines of folder/metal
+        self.inherited_outputs = list(inherited['outputs'])
+        self.index.outputs += [os.path.relpath(path, folder or '.').replace(os.sep, '/') for path in self.inherited_outputs]
+
+    def select_generated(self):
+        # a selector resolved before the generate lines of the other metal
+        # files were merged may take some of their outputs
+        for pack in list(self.execs.values()) + list(self.libraries.values()):
+            if not set(self.index.select(pack.selectors, generated_only=True)).issubset(pack.build_files):
+                pack.sources = [self.project.source(f) for f in self.matches(pack.selectors)]
+
+    def relocate(self, folder):
+        # the selectors of a subdir were resolved inside it, every path has
+        # to be seen from the top folder before merging
+        for pack in list(self.execs.values()) + list(self.libraries.values()):
+            pack.sources = [self.project.source(in_folder(f, folder)) for f in pack.build_files]
+            pack.selectors = [selector_in_folder(sel, folder) for sel in pack.selectors]
+        self.pchs = [(in_folder(header, folder), words, folder) for header, words, _ in self.pchs]
+        self.generates = [([in_folder(o, folder) for o in outputs], [in_folder(i, folder) for i in inputs], command, folder)
+                          for outputs, inputs, command, _ in self.generates]
+        self.unity = dict((t, (size, [selector_in_folder(s, folder) for s in sel])) for t, (size, sel) in self.unity.items())
+        self.pools = dict((n, (depth, [selector_in_folder(s, folder) for s in sel])) for n, (depth, sel) in self.pools.items())
+        self.subdirs = [in_folder(sub, folder) for sub in self.subdirs]
+        self.subdir_inputs = [in_folder('metal', folder)] + [in_folder(d, folder) for d in self.index.scanned_dirs()]
+
+    def merge(self, result):
+        where = in_folder('metal', result['folder'])
+        for text in result['messages'].splitlines():
+            print('{0}: {1}'.format(where, text) if text.startswith(('error', 'syntax error')) else text)
+        for kind, own, found in [('exec', self.execs, result['execs']), ('lib', self.libraries, result['libraries'])]:
+            for name, pack in found.items():
+                if name in self.execs or name in self.libraries:
+                    print('error in', where)
+                    print(kind, name, 'is already declared by another metal file')
+                    continue
+                # the same file is the same SourceFile in the whole project
+                pack.sources = [self.project.source(f.path) for f in pack.sources]
+                own[name] = pack
+        if result['profiles']:
+            print('error in', where)
+            print('profiles are only declared in the top metal file, ignoring', ', '.join(result['profiles']))
+        self.pchs += result['pchs']
+        taken = set(path for outputs, inputs, command, folder in self.generates for path in outputs)
+        for outputs, inputs, command, folder in result['generates']:
+            if taken.intersection(outputs):
+                print('error in', where)
+                print(', '.join(sorted(taken.intersection(outputs))), 'already generated by another metal file')
+                continue
+            taken.update(outputs)
+            self.generates.append((outputs, inputs, command, folder))
+            self.index.outputs += outputs
+        self.unity.update(result['unity'])
+        self.pgo += result['pgo']
+        for name, (depth, selectors) in result['pools'].items():
+            if name in self.pools and self.pools[name][0] != depth:
+                print('error in', where)
+                print('pool', name, 'already declared with depth', self.pools[name][0])
+                continue
+            self.pools[name] = (depth, self.pools.get(name, (depth, []))[1] + selectors)
+        self.used_configs += [cfg for cfg in result['used_configs'] if cfg not in self.used_configs]
+        self.listed_folders.update(result['listed_folders'])
+        self.subdir_inputs += result['inputs']
+        for cache, entries in [(get_config_cache(), result['configs']), (get_pkg_config_cache(), result['pkg_configs'])]:
+            if entries:
+                cache.entries.update(entries)
+                cache.dirty = True
+
+    def debug_profile(self, profile, linker):
+        # only the profiles building debug info get the debug options, and
+        # gcc ignores -gsplit-dwarf with lto
+        if '-g' not in profile['c'] or not self.debug:
+            return profile
+        profile = dict(profile)
+        flags = list(profile['c'])
+        ld = list(profile['ld'])
+        if 'split' in self.debug and not profile['lto']:
+            flags.append('-gsplit-dwarf')
+            profile['split'] = True
+            if linker is not None:
+                # gdb finds what it needs in the .dwo files through the
+                # index, which bfd can't build
+                ld.append('-Wl,--gdb-index')
+        if 'compressed' in self.debug:
+            flags.append('-gz')
+            ld.append('-gz')
+        profile['c'] = profile['cpp'] = flags
+        profile['ld'] = ld
+        return profile
+
+    def compile_flags(self, pack, lang, profile):
+        # the target's own flags, the profile's but the disabled ones, then
+        # the configlibs'
+        if lang == '.c':
+            only, flags, disabled = pack.c_only, profile['c'], pack.c_disabled
+        elif lang == '.cpp':
+            only, flags, disabled = pack.cpp_only, profile['cpp'], pack.cpp_disabled
+        else:
+            return None
+        return sys.intern('{0}{1} {2}'.format(only, ' '.join(f for f in flags if f not in disabled), pack.compiler_f))
+
+    def resolve_pools(self):
+        # links go to the link pool unless the metal file says otherwise,
+        # compiles only go to a pool when their source is selected for it
+        self.pool_files = []
+        pools = dict(self.pools)
+        if 'link' not in pools:
+            pools['link'] = (LINK_POOL_DEPTH, [])
+        for name, (depth, selectors) in pools.items():
+            if selectors:
+                self.pool_files.append((name, set(self.index.select(selectors))))
+        return pools
+
+    def compile_pool(self, file):
+        files = self.unity_members.get(file, [file])
+        for name, selected in self.pool_files:
+            if any(f in selected for f in files):
+                return name
+        return None
+
+    def resolve_pchs(self):
+        # words after 'for' are exec or lib names, anything else is a selector
+        self.pch_targets = []
+        for header, words, folder in self.pchs:
+            names = set(w for w in words if w in self.execs or w in self.libraries)
+            selectors = [selector_in_folder(w, folder) for w in words if w not in names]
+            selected = set(self.index.select(selectors)) if selectors else None
+            self.pch_targets.append((header, names, selected))
+
+    def pch_header(self, target, file):
+        for header, names, selected in self.pch_targets:
+            if (names or selected is not None) and target not in names and (selected is None or file not in selected):
+                continue
+            return header
+        return None
+
+    def unity_units(self, target, units):
+        # batches of sources with the same language and flags become one
+        # translation unit including all of them
+        size, excluded = self.unity[target]
+        excluded = set(self.index.select(excluded)) if excluded else set()
+        groups = {}
+        result = []
+        for file, flags, pch in units:
+            if file in excluded:
+                result.append((file, flags, pch))
+            else:
+                groups.setdefault((os.path.splitext(file)[1], flags, pch), []).append(file)
+        folder = 'obj/unity/' + target
+        count = 0
+        for (lang, flags, pch), files in groups.items():
+            for idx in range(0, len(files), size):
+                batch = files[idx:idx + size]
+                if len(batch) == 1:
+                    result.append((batch[0], flags, pch))
+                    continue
+                name = '{0}/unity_{1}{2}'.format(folder, count, lang)
+                count += 1
+                os.makedirs(folder, exist_ok=True)
+                with atomic_writer(name) as out:
+                    for file in batch:
+                        out.write('#include "{0}"\n'.format(os.path.relpath(file, folder).replace(os.sep, '/')))
+                if name not in self.generated:
+                    self.generated.append(name)
+                self.unity_members[name] = batch
+                result.append((name, flags, pch))
+        return result
+
+    def profile_targets(self, profile):
+        targets = [('lib', t, p) for t, p in self.libraries.items()] + [('exec', t, p) for t, p in self.execs.items()]
+        if profile['only'] is not None:
+            # a pgo build only has its exec and the libs it links
+            wanted = self.execs[profile['only']].archives
+            targets = [t for t in targets if (t[0] == 'lib' and t[1] in wanted) or (t[0] == 'exec' and t[1] == profile['only'])]
+        return targets
+
+    def plan_objects(self, profile, obj_ext):
+        # objects are shared by every target compiling the same source with
+        # the same flags
+        objects = {}
+        variants = {}
+        pchs = {}
+        target_objects = {}
+        obj_dir = profile['obj_dir']
+        targets = self.profile_targets(profile)
+        for kind, target, pack in targets:
+            units = []
+            # the flags only depend on the language within a target
+            lang_flags = {}
+            for source in pack.sources:
+                file, lang = source.path, source.lang
+                if lang not in lang_flags:
+                    lang_flags[lang] = self.compile_flags(pack, lang, profile)
+                flags = lang_flags[lang]
+                if flags is None:
+                    continue
+                header = self.pch_header(target, file)
+                pch = None
+                if header is not None:
+                    # the header is precompiled with the flags of the objects using it
+                    pch_key = (header, lang, flags)
+                    if pch_key not in pchs:
+                        pchs[pch_key] = '{0}pch/{1}/{2}.gch'.format(obj_dir, hashlib.sha1(flags.encode()).hexdigest()[:8], object_path(header, '', obj_dir=''))
+                    pch = pchs[pch_key]
+                    flags = sys.intern(flags + ' -include ' + pch[:-4])
+                units.append((file, flags, pch))
+            if target in self.unity:
+                units = self.unity_units(target, units)
+            target_objects[(kind, target)] = []
+            for file, flags, pch in units:
+                key = (file, flags)
+                if key not in objects:
+                    objects[key] = {'pch': pch}
+                    variants[file] = variants.get(file, 0) + 1
+                target_objects[(kind, target)].append(key)
+        for (file, flags), obj in objects.items():
+            obj['obj'] = object_path(file, obj_ext, flags if variants[file] > 1 else None, obj_dir)
+        return objects, pchs, target_objects
+
+    def gen_ninja(self, out):
         if sys.platform.startswith('win32'):
             obj_ext = '.obj'
             exe_ext = '.exe'
+            lib_name = '{0}.lib'
         elif sys.platform.startswith('linux'):
             obj_ext = '.o'
             exe_ext = ''
+            lib_name = 'lib{0}.a'
 
-        ninja_rules = ''
-        ninja_builds = ''
-        lang_rules = []
-        for target, pack in self.execs.items():
-            real_files = []
-            # print(target)
-            # print(pack)
-            for file in pack['build_files']:
-                obj_file = ''
-                if file.endswith('.c') or file.endswith('.cpp'):
-                    local = file
-                    while local.startswith('../'):
-                        local = local[3:]
-                    obj_dir = 'obj/'
-                    obj_file = obj_dir + local + obj_ext
+        # the unity sources are written again by every generation, watch
+        # mode generates many times with the same parser
+        self.generated = list()
+        self.unity_members = dict()
+        # the selectors and configs are resolved once, every profile only
+        # changes the flags and the folders; rules come before the builds
+        self.resolve_libs()
+        self.resolve_pchs()
+        pools = self.resolve_pools()
+        profiles = self.profiles or [make_profile(None, [])]
+        for number, target, base, train in self.pgo:
+            if target not in self.execs:
+                print('error at line', number)
+                print('pgo of unknown exec', target)
+                continue
+            profiles = profiles + make_pgo_profiles(target, base, train)
+        linker = find_linker(self.linker) if self.linker else None
+        if self.linker and linker is None:
+            print('-- no', 'fast linker' if self.linker == 'fast' else self.linker, 'usable by g++, linking with the default one')
+        profiles = [self.debug_profile(profile, linker) for profile in profiles]
+        plans = [(profile,) + self.plan_objects(profile, obj_ext) for profile in profiles]
+        # the optimized objects need the .gcda of their instrumented twin,
+        # copied next to them where gcc looks for it; an archive member the
+        # linker left out has none, so training and copying end in stamps
+        # instead of listing every .gcda as an output
+        gcdas = {}
+        for idx, (profile, objects, pchs, target_objects) in enumerate(plans):
+            if profile['pgo'] != 'use':
+                continue
+            gen_objects, gen_targets = plans[idx - 1][1], plans[idx - 1][3]
+            stamp = profile['obj_dir'] + 'profile.stamp'
+            pairs = []
+            for key, keys in target_objects.items():
+                for gen_key, use_key in zip(gen_targets[key], keys):
+                    gen_gcda = os.path.splitext(gen_objects[gen_key]['obj'])[0] + '.gcda'
+                    use_gcda = os.path.splitext(objects[use_key]['obj'])[0] + '.gcda'
+                    if objects[use_key].get('gcda') is None:
+                        objects[use_key]['gcda'] = stamp
+                        pairs.append((gen_gcda, use_gcda))
+            gcdas[profile['name']] = (plans[idx - 1][0]['obj_dir'] + 'train.stamp', stamp, pairs)
+        langs = set()
+        pch_langs = set()
+        for profile, objects, pchs, target_objects in plans:
+            langs.update(os.path.splitext(file)[1] for file, flags in objects)
+            pch_langs.update(lang for header, lang, flags in pchs)
+
+        out.write('builddir = ninja\n')
+        # compiles go through the object cache wrapper when metal asks for it
+        wrapper = ''
+        flush = False
+        if self.cache and langs:
+            remote = ' --remote {0}'.format(ninja_escape(self.cache_remote)) if self.cache_remote else ''
+            out.write('OBJCACHE = {0} {1} --max-size {2}{3} --\n'.format(ninja_escape(sys.executable),
+                      ninja_escape(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'objcache.py')), self.cache, remote))
+            wrapper = '$OBJCACHE '
+        if wrapper and (self.cache_remote or os.environ.get('SHURIKEN_REMOTE_CACHE')):
+            # the uploads to the remote cache run after the compiles, a
+            # build only ends once they're done or given up on
+            flush = True
+            out.write('rule flush_uploads\n')
+            out.write('  command = {0} {1} --flush && touch $out\n'.format(ninja_escape(sys.executable),
+                      ninja_escape(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'objcache.py'))))
+            out.write('  description = wait for the cache uploads\n\n')
+        for name, (depth, selectors) in pools.items():
+            out.write('pool {0}\n'.format(name))
+            out.write('  depth = {0}\n\n'.format(depth))
+        if '.c' in langs:
+            out.write('CC = gcc\n')
+            out.write('rule compile_c\n')
+            out.write('  command = ' + wrapper + '$CC ${c_flags} -MMD -MT $out -MF $out.dep -c $in -o $out\n')
+            out.write('  description = compile(c) $out\n')
+            out.write('  depfile = $out.dep\n')
+            out.write('  deps = gcc\n\n')
+        if '.c' in pch_langs:
+            out.write('rule pch_c\n')
+            out.write('  command = ' + wrapper + '$CC ${c_flags} -x c-header -MMD -MT $out -MF $out.dep -c $in -o $out\n')
+            out.write('  description = pch(c) $out\n')
+            out.write('  depfile = $out.dep\n')
+            out.write('  deps = gcc\n\n')
+        if '.cpp' in langs:
+            out.write('CXX = g++\n')
+            out.write('rule compile_cpp\n')
+            out.write('  command = ' + wrapper + '$CXX ${cxx_flags} -MMD -MT $out -MF $out.dep -c $in -o $out\n')
+            out.write('  description = compile(cpp) $out\n')
+            out.write('  depfile = $out.dep\n')
+            out.write('  deps = gcc\n\n')
+        if '.cpp' in pch_langs:
+            out.write('rule pch_cpp\n')
+            out.write('  command = ' + wrapper + '$CXX ${cxx_flags} -x c++-header -MMD -MT $out -MF $out.dep -c $in -o $out\n')
+            out.write('  description = pch(cpp) $out\n')
+            out.write('  depfile = $out.dep\n')
+            out.write('  deps = gcc\n\n')
+        if self.libraries:
+            out.write('AR = ar\n')
+            out.write('rule archive\n')
+            out.write('  command = rm -f $out && $AR ${ar_flags} $out @$out.rsp\n')
+            out.write('  description = archive $out\n')
+            out.write('  pool = link\n')
+            out.write('  rspfile = $out.rsp\n')
+            out.write('  rspfile_content = $in\n\n')
+        if self.execs:
+            out.write('LINKER_EXE = g++\n')
+            out.write('rule link_exe\n')
+            fuse = '-fuse-ld={0} '.format(linker) if linker else ''
+            out.write('  command = $LINKER_EXE ' + fuse + '${ld_flags} -o $out @$out.rsp ${ld_libs}\n')
+            out.write('  description = link(exe) $out\n')
+            out.write('  pool = link\n')
+            out.write('  rspfile = $out.rsp\n')
+            out.write('  rspfile_content = $in\n\n')
+        if gcdas:
+            out.write('rule pgo_train\n')
+            out.write("  command = find $objdir -name '*.gcda' -delete && $train && touch $out\n")
+            out.write('  description = train $in\n\n')
+            # pairs of instrumented and optimized .gcda, a missing one
+            # removes a stale copy
+            out.write('rule pgo_profile\n')
+            out.write('  command = xargs -n 2 sh -c \'if [ -f "$$0" ]; then mkdir -p "$${1%/*}" && cp "$$0" "$$1"; else rm -f "$$1"; fi\' < $out.rsp && touch $out\n')
+            out.write('  description = profile $out\n')
+            out.write('  rspfile = $out.rsp\n')
+            out.write('  rspfile_content = $pairs\n\n')
+        if self.generates:
+            # the command goes through a file, the wrapper runs it and puts
+            # back the mtime of the outputs written with the same bytes
+            out.write('rule generate\n')
+            out.write('  command = {0} {1} $cmdfile $out\n'.format(ninja_escape(sys.executable),
+                      ninja_escape(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'generate.py'))))
+            out.write('  description = generate $out\n')
+            out.write('  rspfile = $cmdfile\n')
+            out.write('  rspfile_content = $cmd\n')
+            out.write('  restat = 1\n\n')
+        if self.regen_inputs:
+            out.write('SHURIKEN = {0} {1}\n'.format(ninja_escape(sys.executable), ninja_escape(os.path.realpath(__file__))))
+            out.write('rule regenerate\n')
+            out.write('  command = $SHURIKEN regenerate\n')
+            out.write('  description = regenerate build.ninja\n')
+            out.write('  generator = 1\n')
+            out.write('  restat = 1\n\n')
+            out.write('rule listing\n')
+            out.write("  command = (LC_ALL=C ls -A $in | grep -vxF -e '' $own) > $out.tmp; if cmp -s $out.tmp $out; then rm $out.tmp; else mv $out.tmp $out; fi\n")
+            out.write('  description = list $in\n')
+            # like regenerate, written by shuriken before ninja ever ran it
+            out.write('  generator = 1\n')
+            out.write('  restat = 1\n\n')
+
+        defaults = []
+        # every output with the target and sources it comes from, for the
+        # tools reading the build log afterwards
+        self.graph = {}
+        # the compilation database for editors, which can't read a .gch:
+        # they are given the header it was made from; one entry per source,
+        # the one of the default profile, as a second one would conflict
+        self.compdb = []
+        in_compdb = set()
+        # compiles wait for every generated file, a generated header isn't
+        # in any depfile before the first compile
+        order_only = ''
+        for outputs, inputs, command, folder in self.generates:
+            cmd = command.replace('$', '$$')
+            for name, paths in [('in', inputs), ('out', outputs), ('dir', [folder or '.'])]:
+                cmd = cmd.replace('$${0}$$'.format(name), ' '.join(ninja_escape(p) for p in paths))
+            out.write('build {0}: generate{1}\n'.format(' '.join(outputs), ''.join(' ' + p for p in inputs)))
+            # ninja creates the builddir but not folders for the rspfiles
+            out.write('  cmdfile = ninja/generate-{0}.sh\n'.format(hashlib.sha1(outputs[0].encode()).hexdigest()[:8]))
+            out.write('  cmd = {0}\n'.format(cmd))
+            for path in outputs:
+                self.graph[path] = dict(rule='generate', profile=None, targets=[], sources=[], inputs=inputs)
+        if self.generates:
+            out.write('build ninja/generated: phony {0}\n'.format(' '.join(p for outputs, _, _, _ in self.generates for p in outputs)))
+            order_only = ' || ninja/generated'
+        for profile, objects, pchs, target_objects in plans:
+            pch_headers = dict((pch, header) for (header, lang, flags), pch in pchs.items())
+            out_dir = profile['out_dir']
+            outputs = []
+            for (kind, target), keys in target_objects.items():
+                for key in keys:
+                    objects[key].setdefault('targets', [])
+                    if target not in objects[key]['targets']:
+                        objects[key]['targets'].append(target)
+            if profile['name'] in gcdas:
+                trained, stamp, pairs = gcdas[profile['name']]
+                out.write('build {0}: pgo_profile {1}\n'.format(stamp, trained))
+                out.write('  pairs = {0}\n'.format(' '.join(p for pair in pairs for p in pair)))
+                self.graph[stamp] = dict(rule='pgo_profile', profile=profile['name'], targets=[profile['only']], sources=[], inputs=[trained])
+            for (header, lang, flags), pch in pchs.items():
+                # gcc warns about '#pragma once in main file' when it's given
+                # the header itself; a header including it is precompiled and
+                # -include'd instead, like cmake does
+                wrapper_header = pch[:-4]
+                os.makedirs(os.path.dirname(wrapper_header), exist_ok=True)
+                with atomic_writer(wrapper_header) as wrapper_out:
+                    wrapper_out.write('#include "{0}"\n'.format(os.path.relpath(header, os.path.dirname(wrapper_header)).replace(os.sep, '/')))
+                if wrapper_header not in self.generated:
+                    self.generated.append(wrapper_header)
+                self.graph[pch] = dict(rule='pch', profile=profile['name'], targets=[], sources=[header], inputs=[wrapper_header])
+                if lang == '.c':
+                    out.write('build {0}: pch_c {1}{2}\n'.format(pch, wrapper_header, order_only))
+                    out.write('  c_flags = {0}\n'.format(flags))
+                else:
+                    out.write('build {0}: pch_cpp {1}{2}\n'.format(pch, wrapper_header, order_only))
+                    out.write('  cxx_flags = {0}\n'.format(flags))
+
+            for (file, flags), obj in objects.items():
+                # gcc leaves a used .gch out of the depfile, so it's an implicit input
+                implicit = [d for d in (obj['pch'], obj.get('gcda')) if d]
+                deps = (' | ' + ' '.join(implicit) if implicit else '') + order_only
+                built = obj['obj']
+                if profile['split']:
+                    # gcc writes the split debug info next to the object
+                    built += ' | ' + os.path.splitext(obj['obj'])[0] + '.dwo'
                 if file.endswith('.c'):
-                    if not 'c' in lang_rules:
-                        ninja_rules += 'CC = gcc\n'
-                        ninja_rules += 'rule compile_c\n'
-                        ninja_rules += '  command = $CC ${c_flags} -MMD -MT $out -MF $out.dep -c $in -o $out\n'
-                        ninja_rules += '  description = compile(c) $out\n'
-                        ninja_rules += '  depfile = $out.dep\n'
-                        ninja_rules += '  deps = gcc\n\n'
-                        lang_rules.append('c')
-                        pass
-                    # if pack['section']:
-                    obj_dir = 'obj/'
-                    #     obj_dir = pack['section'] + '_obj/'
-                    #     pass
-                    ninja_builds += 'build {0}: compile_c {1}\n'.format(obj_file, file)
-                    real_files.append('{0}'.format(obj_file))
-                    # if pack['comp_flags']:
-                    ninja_builds += '  c_flags = {0}{1}\n'.format(pack['c_only'], pack['compiler_f'])
-                        # pass
-                    # if 'libs' in pack:
-                        # ninja_builds += '  c_flags ='
-                        # for lib, lib_path in pack['libs']:
-                            # ninja_builds += ' -I%s' % os.path.join(lib_path, 'include')
-                        # ninja_builds += '\n'
-                        # pass
-                    pass
-                if file.endswith('.cpp'):
-                    if not 'cpp' in lang_rules:
-                        ninja_rules += 'CXX = g++\n'
-                        ninja_rules += 'rule compile_cpp\n'
-                        ninja_rules += '  command = $CXX ${cxx_flags} -MMD -MT $out -MF $out.dep -c $in -o $out\n'
-                        ninja_rules += '  description = compile(cpp) $out\n'
-                        ninja_rules += '  depfile = $out.dep\n'
-                        ninja_rules += '  deps = gcc\n\n'
-                        lang_rules.append('cpp')
-                        pass
-                    obj_dir = 'obj/'
-                    ninja_builds += 'build {0}: compile_cpp {1}\n'.format(obj_file, file)
-                    real_files.append('{0}'.format(obj_file))
-                    ninja_builds += '  cxx_flags = {0} {1}\n'.format(pack['cpp_only'], pack['compiler_f'])
-                    pass
-                pass
-            pass
-            if not 'link' in lang_rules:
-                ninja_rules += 'LINKER_EXE = g++\n'
-                ninja_rules += 'rule link_exe\n'
-                ninja_rules += '  command = $LINKER_EXE ${ld_flags} -o $out $in ${ld_libs}\n'
-                ninja_rules += '  description = link(exe) $out\n\n'
-                lang_rules.append('link')
-                pass
-            # print(len(real_files))
-            # if len(real_files > 1)
-            ninja_builds += 'build {0}{1}: link_exe {2}\n'.format(target, exe_ext, ' '.join(real_files))
-            # if 'libs' in pack:
-            if pack['linker_f'] != '':
-                ninja_builds += '  ld_flags = {0}\n'.format(pack['linker_f'])
-                # for lib, lib_path in pack['libs']:
-                    # ninja_builds += ' -L%s' % os.path.join(lib_path, 'lib')
-                # ninja_builds += '\n'
-            if pack['linker_libs'] != '':
-                ninja_builds += '  ld_libs = {0}\n'.format(pack['linker_libs'])
-                # for lib, lib_path in pack['libs']:
-                    # ninja_builds += ' -l%s' % lib
-                # ninja_builds += '\n'
-            pass
+                    out.write('build {0}: compile_c {1}{2}\n'.format(built, file, deps))
+                    out.write('  c_flags = {0}\n'.format(flags))
+                else:
+                    out.write('build {0}: compile_cpp {1}{2}\n'.format(built, file, deps))
+                    out.write('  cxx_flags = {0}\n'.format(flags))
+                pool = self.compile_pool(file)
+                if pool is not None:
+                    out.write('  pool = {0}\n'.format(pool))
+                self.graph[obj['obj']] = dict(rule='compile', profile=profile['name'], targets=obj['targets'],
+                                              sources=self.unity_members.get(file, [file]), inputs=[file] + implicit)
+                if obj['pch']:
+                    flags = flags.replace(' -include ' + obj['pch'][:-4], ' -include ' + pch_headers[obj['pch']])
+                for source in self.unity_members.get(file, [file]):
+                    if profile is plans[0][0] and source not in in_compdb:
+                        in_compdb.add(source)
+                        self.compdb.append(dict(directory=os.getcwd(), file=source, output=obj['obj'],
+                                                command='{0} {1} -c {2} -o {3}'.format('gcc' if source.endswith('.c') else 'g++', flags, source, obj['obj'])))
+
+            for kind, target, pack in self.profile_targets(profile):
+                if kind != 'lib':
+                    continue
+                real_files = [objects[key]['obj'] for key in target_objects[('lib', target)]]
+                outputs.append(out_dir + lib_name.format(target))
+                out.write('build {0}: archive {1}\n'.format(outputs[-1], ' '.join(real_files)))
+                self.graph[outputs[-1]] = dict(rule='archive', profile=profile['name'], targets=[target], sources=[], inputs=real_files)
+                out.write('  ar_flags = {0}\n'.format('rcsT' if pack.thin else 'rcs'))
+                if profile['lto']:
+                    # the archive index has to know about the lto symbols
+                    out.write('  AR = gcc-ar\n')
+
+            for kind, target, pack in self.profile_targets(profile):
+                if kind != 'exec':
+                    continue
+                real_files = [objects[key]['obj'] for key in target_objects[('exec', target)]]
+                # archives come after the objects and before the ones they depend on
+                real_files += [out_dir + lib_name.format(lib) for lib in reversed(pack.archives)]
+                outputs.append(out_dir + target + exe_ext)
+                out.write('build {0}: link_exe {1}\n'.format(outputs[-1], ' '.join(real_files)))
+                self.graph[outputs[-1]] = dict(rule='link', profile=profile['name'], targets=[target], sources=[], inputs=real_files)
+                if pack.test:
+                    self.graph[outputs[-1]]['test'] = True
+                ld_flags = ' '.join(f for f in [' '.join(profile['ld']), pack.linker_f] if f)
+                if ld_flags != '':
+                    out.write('  ld_flags = {0}\n'.format(ld_flags))
+                if pack.linker_libs != '':
+                    out.write('  ld_libs = {0}\n'.format(pack.linker_libs))
+
+            if profile['pgo'] == 'gen':
+                # running the instrumented exec writes a .gcda per linked
+                # object, the ones of an earlier training are removed first
+                trained = profile['obj_dir'] + 'train.stamp'
+                exe = out_dir + profile['only'] + exe_ext
+                out.write('build {0}: pgo_train {1}\n'.format(trained, exe))
+                out.write('  objdir = {0}\n'.format(profile['obj_dir']))
+                self.graph[trained] = dict(rule='pgo_train', profile=profile['name'], targets=[profile['only']], sources=[], inputs=[exe])
+                # $exec$ in the training command is the instrumented exec, like $path$ in the .cfg files
+                out.write('  train = {0}\n'.format(profile['train'].replace('$', '$$').replace('$$exec$$', exe)))
+            if flush and outputs:
+                flushed = profile['obj_dir'] + 'uploads.stamp'
+                out.write('build {0}: flush_uploads | {1}\n'.format(flushed, ' '.join(outputs)))
+                self.graph[flushed] = dict(rule='flush_uploads', profile=profile['name'], targets=[], sources=[], inputs=list(outputs))
+                outputs.append(flushed)
+            if profile['name'] is not None:
+                out.write('build {0}: phony {1}\n'.format(profile['name'], ' '.join(outputs)))
+            if profile['pgo'] is None:
+                defaults += outputs
+        if self.profiles:
+            out.write('default {0}\n'.format(self.profiles[0]['name']))
+        elif self.pgo:
+            # plain ninja shouldn't run the training
+            out.write('default {0}\n'.format(' '.join(defaults)))
+
+        if self.regen_inputs:
+            # a folder is read through its listing, so a link replacing a
+            # name in it doesn't run shuriken again
+            # without the names shuriken and ninja write there
+            inputs = list()
+            own = self.own_names()
+            for path in self.regen_inputs:
+                if os.path.isdir(path):
+                    out.write('build {0}: listing {1}\n'.format(ninja_escape(listing_file(path)), ninja_escape(path)))
+                    skipped = ("-e '{0}'".format(name.replace("'", "'\\''")) for name in sorted(own.get(path, ())))
+                    out.write('  own = {0}\n'.format(' '.join(skipped).replace('$', '$$')))
+                    path = listing_file(path)
+                inputs.append(ninja_escape(path))
+            # the other files shuriken writes are older than the folders
+            # holding them: as outputs they'd leave build.ninja dirty, as
+            # inputs they only make a deleted one written again
+            written = [ninja_escape(p) for p in self.generated + [GRAPH_FILE, COMPDB_FILE]]
+            for path in written:
+                out.write('build {0}: phony\n'.format(path))
+            out.write('build build.ninja: regenerate {0} | {1}\n'.format(' '.join(inputs), ' '.join(written)))
+
+def parse_subdir(top, folder, config_files, inherited):
+    # runs in a worker process: the selectors of folder/metal are resolved
+    # inside folder, then every path is moved under it; what it prints is
+    # sent back, the workers would mix their messages otherwise
+    import io
+    import contextlib
+    os.chdir(os.path.join(top, folder))
+    par = metal_parser()
+    par.set_found_configs(config_files)
+    par.inherit(inherited, folder)
+    with contextlib.redirect_stdout(io.StringIO()) as messages:
+        if os.path.isfile('metal'):
+            with open('metal') as file:
+                par.metal_lines(file.readlines())
+        else:
+            print('no metal file found in', folder)
+    par.relocate(folder)
+    cache = get_config_cache()
+    pkg_cache = get_pkg_config_cache()
+    return dict(folder=folder, execs=par.execs, libraries=par.libraries, pchs=par.pchs, unity=par.unity,
+                pools=par.pools, pgo=par.pgo, generates=par.generates, profiles=[p['name'] for p in par.profiles],
+                used_configs=par.used_configs, listed_folders=par.listed_folders, inputs=par.subdir_inputs, subdirs=par.subdirs,
+                inherited=par.inherited(), configs=cache.entries if cache.dirty else {},
+                pkg_configs=pkg_cache.entries if pkg_cache.dirty else {}, messages=messages.getvalue())
+
+def parse_subdirs(par, config_files):
+    # a subdir only waits for the metal file including it, independent
+    # subtrees are parsed at the same time; the results come back in the
+    # order of the subdir lines, whatever order the workers finished in
+    from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+    top = os.getcwd()
+    results = {}
+    with ProcessPoolExecutor() as workers:
+        running = {}
+        for folder in par.subdirs:
+            running[workers.submit(parse_subdir, top, folder, config_files, par.inherited())] = folder
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                result = future.result()
+                results[running.pop(future)] = result
+                for folder in result['subdirs']:
+                    if folder not in results and folder not in running.values():
+                        running[workers.submit(parse_subdir, top, folder, config_files, result['inherited'])] = folder
+    ordered = []
+    stack = list(reversed(par.subdirs))
+    while stack:
+        folder = stack.pop()
+        if folder in results:
+            ordered.append(results.pop(folder))
+            stack += reversed(ordered[-1]['subdirs'])
+    return ordered
 
-        ninja_file = 'builddir = ninja\n'
-        ninja_file += ninja_rules
-        ninja_file += ninja_builds
-        # print(ninja_file)
-        # output = open(os.path.join(os.path.dirname(path_to_metal), 'build.ninja'), 'w')
-        # output.write(ninja_file)
-        # output.close()
-        # os.chdir(before)
-        return ninja_file
-
-def shuriken(path_to_metal):
+def load_project(path_to_metal, config_files):
+    # the metal file with every subdir merged in, run from the metal folder
+    par = metal_parser()
+    par.set_found_configs(config_files)
+    with open(path_to_metal) as file:
+        par.metal_lines(file.readlines())
+    if par.subdirs:
+        for result in parse_subdirs(par, config_files):
+            par.merge(result)
+        par.select_generated()
+    par.collect_regen_inputs(os.path.basename(path_to_metal))
+    return par
+
+def write_project(par):
+    # every output is only replaced when its content changed; build.ninja is
+    # replaced last and touched after the listings, so nothing shuriken
+    # writes is newer than build.ninja or than the stamp
+    with atomic_writer('build.ninja') as manifest:
+        par.gen_ninja(manifest)
+        # json.dump to a file goes through the pure python encoder, dumps of
+        # every entry uses the C one; the graph and the database are still
+        # built whole in memory, only their encoded text is streamed
+        with atomic_writer(GRAPH_FILE) as out:
+            out.write('{')
+            for idx, output in enumerate(sorted(par.graph)):
+                out.write('{0}{1}: {2}'.format(', ' if idx else '', json.dumps(output), json.dumps(par.graph[output], sort_keys=True)))
+            out.write('}')
+        # so editors don't index it again after a no-op regeneration
+        with atomic_writer(COMPDB_FILE) as out:
+            out.write('[')
+            for idx, entry in enumerate(par.compdb):
+                out.write('{0}\n{1}'.format(',' if idx else '', json.dumps(entry, sort_keys=True)))
+            out.write('\n]\n')
+        get_config_cache().save()
+        get_pkg_config_cache().save()
+        get_linker_cache().save()
+    write_listings(par)
+    write_stamp(par)
+
+def restat_log(par):
+    # run outside of ninja, the mtimes its log recorded for build.ninja and
+    # the listings are older than the new inputs and the first ninja
+    # afterwards would regenerate for nothing: an entry with the current
+    # mtime is appended for each, ninja keeps the last one of an output
+    log_file = os.path.join('ninja', '.ninja_log')
+    outputs = ['build.ninja'] + [listing_file(p) for p in par.regen_inputs if os.path.isdir(p)]
+    hashes = {}
+    end = '0'
+    try:
+        with open(log_file) as log:
+            if not log.readline().startswith('# ninja log v'):
+                return
+            for line in log:
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) < 5:
+                    continue
+                # the same finish time, a report still sees one build
+                end = fields[1]
+                if fields[3] in outputs:
+                    hashes[fields[3]] = fields[4]
+    except IOError:
+        return
+    with open(log_file, 'a') as log:
+        for output in outputs:
+            if output in hashes:
+                log.write('{0}\t{0}\t{1}\t{2}\t{3}\n'.format(end, os.stat(output).st_mtime_ns, output, hashes[output]))
+
+def write_stamp(par):
+    inputs = par.regen_inputs + par.generated + [GRAPH_FILE, COMPDB_FILE]
+    own = par.own_names()
+    files = [p for p in inputs if not os.path.isdir(p)]
+    listings = [(p, par.listed_folders.get(p, ''), own.get(p, ())) for p in inputs if os.path.isdir(p)]
+    os.makedirs(os.path.dirname(STAMP_FILE), exist_ok=True)
+    with open(STAMP_FILE, 'w') as stamp:
+        json.dump(make_fingerprint(files, listings), stamp)
+
+def shuriken(path_to_metal, from_ninja=False):
     # compiler, linker, libs = get_configs()
-    config_files = get_config_files()
     # recurse = False
     before = os.getcwd()
     if os.path.dirname(path_to_metal) != os.getcwd():
         os.chdir(os.path.dirname(path_to_metal))
+    if is_up_to_date('build.ninja', STAMP_FILE):
+        os.chdir(before)
+        return
+    config_files = get_config_files()
     # print(os.getcwd())
     # print(path_to_metal)
     # print('hello')
@@ -531,13 +1972,8 @@ def shuriken(path_to_metal):
     # else:
     # walk_entries += [(sources, [], os.listdir(sources))]
     # print(path_to_metal)
-    par = metal_parser()
+    par = load_project(path_to_metal, config_files)
     # print(par.execs)
-    par.set_found_configs(config_files)
-    with open(path_to_metal) as file:
-        lines = file.readlines()
-        for number, line in enumerate(lines):
-            par.metal_line(number, line)
 
         ######################
         # line = file.readline()
@@ -690,7 +2126,9 @@ def shuriken(path_to_metal):
     # print('\n')
     # print(par.execs)
 
-    ninja = par.gen_ninja()
+    write_project(par)
+    if not from_ninja:
+        restat_log(par)
     # ninja_rules = ''
     # ninja_builds = ''
     # lang_rules = []
@@ -784,9 +2222,6 @@ def shuriken(path_to_metal):
     # ninja_file += ninja_rules
     # ninja_file += ninja_builds
     # print(ninja_file)
-    output = open(os.path.join(os.path.dirname(path_to_metal), 'build.ninja'), 'w')
-    output.write(ninja)
-    output.close()
     os.chdir(before)
 
 if __name__ == '__main__':
@@ -794,8 +2229,28 @@ if __name__ == '__main__':
     
     # get_configs()
     
+    if sys.argv[1:2] == ['report']:
+        from report import main
+        sys.exit(main(sys.argv[2:]))
+    if sys.argv[1:2] == ['watch']:
+        from watch import main
+        sys.exit(main(sys.argv[2:]))
+    if sys.argv[1:2] == ['cache']:
+        from objcache import main
+        sys.exit(main(sys.argv[2:] or ['--stats']))
+    if sys.argv[1:2] == ['cache-server']:
+        from cache_server import main
+        sys.exit(main(sys.argv[2:]))
+    if sys.argv[1:2] == ['test']:
+        from testrunner import main
+        sys.exit(main(sys.argv[2:]))
+    if sys.argv[1:2] == ['affected']:
+        from affected import main
+        sys.exit(main(sys.argv[2:]))
+
     metal_file = os.path.join(os.getcwd(), 'metal')
     if os.path.isfile(metal_file):
-        shuriken(metal_file)
+        # regenerate is how the edge of build.ninja runs it
+        shuriken(metal_file, from_ninja=sys.argv[1:2] == ['regenerate'])
     else:
         print('no metal file found')
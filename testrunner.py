@@ -0,0 +1,183 @@
+import os
+import sys
+import json
+import time
+import signal
+import hashlib
+import subprocess
+
+import shuriken
+
+# runs the tests declared with 'test' in metal: the graph written by
+# shuriken tells which outputs are tests, ninja builds them first, then
+# they run in parallel; a test is skipped when its binary and arguments
+# are the same as on its last pass
+
+RESULTS_FILE = 'ninja/tests.json'
+DEFAULT_TIMEOUT = 60.0
+
+def find_tests(graph, profile=None):
+    # output path by test name, for the given profile
+    found = {}
+    for output, node in graph.items():
+        if node.get('test') and node['profile'] == profile:
+            for name in node['targets']:
+                found[name] = output
+    return found
+
+def default_profile(graph, manifest='build.ninja'):
+    # the first declared profile, which build.ninja builds by default;
+    # None when metal declares no profile
+    profiles = set(node['profile'] for node in graph.values() if node['profile'] is not None)
+    if not profiles:
+        return None
+    try:
+        with open(manifest) as f:
+            for line in f:
+                if line.startswith('default '):
+                    for name in line.split()[1:]:
+                        if name in profiles:
+                            return name
+    except IOError:
+        pass
+    raise ValueError('no default profile in ' + manifest)
+
+def shard(names, text):
+    # --shard i/n, 1 <= i <= n: every n-th test of the sorted names, so
+    # every machine of a CI run gets as many tests
+    index, count = (int(part) for part in text.split('/'))
+    if not 1 <= index <= count:
+        raise ValueError('shard {0} is not between 1 and {1}'.format(index, count))
+    return [name for idx, name in enumerate(sorted(names)) if idx % count == index - 1]
+
+def test_key(binary, args):
+    digest = hashlib.sha256()
+    with open(binary, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    for arg in args:
+        digest.update(arg.encode() + b'\0')
+    return digest.hexdigest()
+
+def run_test(binary, args, timeout):
+    # its own process group, a timed out test takes its children with it
+    start = time.perf_counter()
+    proc = subprocess.Popen([os.path.join('.', binary)] + list(args), stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL, start_new_session=True)
+    try:
+        output = proc.communicate(timeout=timeout)[0]
+        state = 'pass' if proc.returncode == 0 else 'fail'
+    except subprocess.TimeoutExpired:
+        os.killpg(proc.pid, signal.SIGKILL)
+        output = proc.communicate()[0]
+        state = 'timeout'
+    return state, time.perf_counter() - start, output.decode(errors='replace')
+
+def load_results(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+def save_results(path, results):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as out:
+        json.dump(results, out, indent=1, sort_keys=True)
+    os.replace(tmp, path)
+
+def run_tests(tests, args=(), jobs=None, timeout=DEFAULT_TIMEOUT, cached=True, verbose=False):
+    # tests is name -> binary; returns how many passed, failed and were
+    # skipped as cached
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    results = load_results(RESULTS_FILE)
+    wanted = []
+    skipped = 0
+    passed = failed = 0
+    for name in sorted(tests):
+        if not os.path.isfile(tests[name]):
+            print('-- missing', name, '({0} is not built)'.format(tests[name]))
+            failed += 1
+            continue
+        key = test_key(tests[name], args)
+        if cached and results.get(name, {}).get('key') == key:
+            skipped += 1
+            continue
+        wanted.append((name, key))
+    # the longest ones first, they'd otherwise finish last on a lone core
+    wanted.sort(key=lambda test: -results.get(test[0], {}).get('time', 0.0))
+    with ThreadPoolExecutor(max_workers=jobs or os.cpu_count() or 1) as workers:
+        running = dict((workers.submit(run_test, tests[name], args, timeout), (name, key)) for name, key in wanted)
+        for future in as_completed(running):
+            name, key = running[future]
+            state, spent, output = future.result()
+            print('-- {0:<7} {1} ({2:.2f}s)'.format(state, name, spent))
+            if state == 'pass':
+                passed += 1
+                results[name] = dict(key=key, time=spent)
+                if verbose and output:
+                    print(output, end='' if output.endswith('\n') else '\n')
+            else:
+                failed += 1
+                results.pop(name, None)
+                if output:
+                    print(output, end='' if output.endswith('\n') else '\n')
+            sys.stdout.flush()
+    os.makedirs(os.path.dirname(RESULTS_FILE), exist_ok=True)
+    save_results(RESULTS_FILE, results)
+    return passed, failed, skipped
+
+def main(args):
+    import argparse
+    parser = argparse.ArgumentParser(prog='shuriken test', description='build and run the tests declared in metal')
+    parser.add_argument('names', nargs='*', help='tests to run, all of them by default')
+    parser.add_argument('-j', '--jobs', type=int, help='tests run at the same time, the number of cores by default')
+    parser.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT, help='seconds before a test is killed (default %(default)s)')
+    parser.add_argument('--shard', help='i/n: run the i-th of n parts of the tests, for several machines')
+    parser.add_argument('--profile', help='run the tests built by this profile, the first declared one by default')
+    parser.add_argument('--no-cache', action='store_true', help='run the tests that passed with the same binary too')
+    parser.add_argument('--no-build', action='store_true', help="don't run ninja on the tests first")
+    parser.add_argument('-v', '--verbose', action='store_true', help='show the output of passing tests too')
+    parser.add_argument('--args', nargs=argparse.REMAINDER, default=[], help='given to every test, the rest of the line')
+    opts = parser.parse_args(args)
+    if not os.path.isfile(shuriken.GRAPH_FILE):
+        print('-- no shuriken graph at', shuriken.GRAPH_FILE, '(run shuriken first)', file=sys.stderr)
+        return 1
+    with open(shuriken.GRAPH_FILE) as f:
+        graph = json.load(f)
+    profile = opts.profile
+    if profile is None:
+        try:
+            profile = default_profile(graph)
+        except ValueError as e:
+            print('--', e, '(run shuriken first)', file=sys.stderr)
+            return 1
+    tests = find_tests(graph, profile)
+    if opts.profile is not None and not tests:
+        print('-- no tests in profile', opts.profile, file=sys.stderr)
+        return 1
+    unknown = [name for name in opts.names if name not in tests]
+    if unknown:
+        print('-- unknown tests:', ' '.join(unknown), file=sys.stderr)
+        return 1
+    if opts.names:
+        tests = dict((name, tests[name]) for name in opts.names)
+    if opts.shard:
+        try:
+            tests = dict((name, tests[name]) for name in shard(tests, opts.shard))
+        except ValueError as e:
+            print('-- bad --shard:', e, file=sys.stderr)
+            return 1
+    if not tests:
+        print('-- no tests to run')
+        return 0
+    if not opts.no_build and subprocess.call(['ninja'] + sorted(tests.values())) != 0:
+        return 1
+    start = time.perf_counter()
+    passed, failed, skipped = run_tests(tests, opts.args, opts.jobs, opts.timeout, not opts.no_cache, opts.verbose)
+    print('-- {0} passed, {1} failed, {2} unchanged since their last pass in {3:.2f}s'.format(
+        passed, failed, skipped, time.perf_counter() - start))
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
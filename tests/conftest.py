@@ -0,0 +1,50 @@
+import os
+import sys
+import shutil
+import subprocess
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+SHURIKEN = os.path.join(ROOT, 'shuriken.py')
+
+def write_tree(root, files):
+    for path, text in files.items():
+        path = os.path.join(str(root), path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(text)
+
+@pytest.fixture(autouse=True)
+def config_dir(tmp_path, monkeypatch):
+    # the .cfg files of the repo, but the caches shuriken writes next to
+    # them stay out of it
+    folder = tmp_path / 'config'
+    shutil.copytree(os.path.join(ROOT, 'config'), str(folder), ignore=shutil.ignore_patterns('*.json'))
+    monkeypatch.setenv('SHURIKEN_CONFIG_DIR', str(folder))
+    monkeypatch.setenv('SHURIKEN_CACHE_DIR', str(tmp_path / 'cache'))
+    for name in ['SHURIKEN_REMOTE_CACHE', 'PKG_CONFIG_PATH', 'PKG_CONFIG_LIBDIR']:
+        monkeypatch.delenv(name, raising=False)
+    return folder
+
+@pytest.fixture
+def project(tmp_path):
+    folder = tmp_path / 'project'
+    folder.mkdir()
+    return folder
+
+def run_shuriken(folder, env=None):
+    proc = subprocess.run([sys.executable, SHURIKEN], cwd=str(folder), env=env, stdout=subprocess.PIPE,
+                          stderr=subprocess.STDOUT, universal_newlines=True)
+    assert proc.returncode == 0, proc.stdout
+    return proc.stdout
+
+def run_ninja(folder, *args):
+    proc = subprocess.run(['ninja'] + list(args), cwd=str(folder), stdout=subprocess.PIPE,
+                          stderr=subprocess.STDOUT, universal_newlines=True)
+    assert proc.returncode == 0, proc.stdout
+    return proc.stdout
+
+needs_toolchain = pytest.mark.skipif(not (shutil.which('ninja') and shutil.which('g++')), reason='needs ninja and g++')
@@ -0,0 +1,67 @@
+import pytest
+
+import shuriken
+
+def old_parse_lines(content):
+    # the character scanner parse_lines replaced, as it was
+    idx = 0
+    path = ''
+    flags = {'compiler': '', 'linker': '', 'libs': ''}
+    if not content.endswith('\n'):
+        content = content + '\n'
+    while idx < len(content):
+        if content.startswith('info', idx):
+            while content[idx] != '"':
+                idx += 1
+            idx += 1
+            while content[idx] != '"':
+                idx += 1
+            while content[idx] != '\n':
+                idx += 1
+            idx += 1
+            continue
+        key = next((k for k in ['path', 'compiler', 'linker', 'libs'] if content.startswith(k, idx)), None)
+        if key is None:
+            idx += 1
+            continue
+        value = (content[idx:].split(None, 1))[1].split('\n', 1)[0]
+        if key == 'path':
+            path = value
+        else:
+            value += '  '
+            place = value.find('$path$')
+            while place != -1:
+                value = value[:place] + path + value[place + 6:]
+                place = value.find('$path$')
+            flags[key] = value
+        while content[idx] != '\n':
+            idx += 1
+        idx += 1
+    return flags['compiler'].strip(), flags['linker'].strip(), flags['libs'].strip()
+
+CONFIGS = [
+    'path /opt/sfml\ncompiler -I$path$/include\nlinker -L$path$/lib\nlibs -lsfml-graphics -lsfml-window\n',
+    'info "a library"\npath /usr\ncompiler -DX=1\nlibs -lx',
+    'info "spanning\n  two lines, with compiler and libs inside"\ncompiler -DY\n',
+    '\n\npath   /p\n\tcompiler\t-I$path$ -I$path$/more\n  linker  -Wl,-rpath,$path$\n',
+    'compiler -I$path$/early\npath /late\nlibs -L$path$\n',
+    'libs -la\nlibs -lb\n',
+    'linker -pthread',
+    '',
+]
+
+@pytest.mark.parametrize('content', CONFIGS)
+def test_parse_lines_like_the_old_scanner(content):
+    assert shuriken.parse_lines(content) == old_parse_lines(content)
+
+def test_directive_only_at_line_start():
+    # the old scanner took one anywhere, a comment included
+    content = 'compiler -good\n# compiler -bad\n'
+    assert old_parse_lines(content)[0] == '-bad'
+    assert shuriken.parse_lines(content)[0] == '-good'
+
+def test_path_without_trailing_blanks():
+    # the old scanner kept them in every $path$
+    content = 'path /p  \ncompiler -I$path$/include\n'
+    assert old_parse_lines(content)[0] == '-I/p  /include'
+    assert shuriken.parse_lines(content)[0] == '-I/p/include'
@@ -0,0 +1,65 @@
+import os
+import shutil
+
+from conftest import write_tree, run_shuriken
+
+SEEDS = ['0', '1', '2', '3', '4']
+
+FILES = {
+    'metal': 'profile release lto\n'
+             'profile debug\n'
+             'cache 1G\n'
+             'configlib extra\n'
+             'pool heavy 2 for big/*.cpp\n'
+             'lib core core/*.cpp core/*.c using extra\n'
+             'pch inc/common.hpp for app\n'
+             'unity app 2 except main.cpp\n'
+             'generate gen/made.cpp from gen/made.txt run cp $in$ $out$\n'
+             'exec app *.cpp big/*.cpp gen/*.cpp using core\n'
+             'pgo app run ./app\n'
+             'test check t/*.cpp using core\n'
+             'subdir sub tools\n',
+    'main.cpp': 'int main() { return 0; }\n',
+    'a.cpp': 'int a();\nint a() { return 1; }\n',
+    'b.cpp': 'int b();\nint b() { return 2; }\n',
+    'c.cpp': 'int c();\nint c() { return 3; }\n',
+    'big/x.cpp': 'int x();\nint x() { return 4; }\n',
+    'big/y.cpp': 'int y();\nint y() { return 5; }\n',
+    'core/one.cpp': 'int one();\nint one() { return 1; }\n',
+    'core/two.c': 'int two(void);\nint two(void) { return 2; }\n',
+    'inc/common.hpp': '#include <vector>\n',
+    'gen/made.txt': 'int made();\nint made() { return 6; }\n',
+    't/check.cpp': 'int main() { return 0; }\n',
+    'sub/metal': 'exec subapp *.cpp using core\nunity subapp\n',
+    'sub/s1.cpp': 'int main() { return 0; }\n',
+    'sub/s2.cpp': 'int s2();\nint s2() { return 0; }\n',
+    'tools/metal': 'pool link 1 for *.cpp\nlib tool *.cpp\n',
+    'tools/t1.cpp': 'int t1();\nint t1() { return 0; }\n',
+    'tools/t2.cpp': 'int t2();\nint t2() { return 0; }\n',
+}
+
+def generate(folder, config, seed):
+    shutil.rmtree(str(folder), ignore_errors=True)
+    for cache in config.glob('*.json'):
+        cache.unlink()
+    write_tree(folder, FILES)
+    env = dict(os.environ, PYTHONHASHSEED=seed)
+    output = run_shuriken(folder, env)
+    assert 'error' not in output, output
+    written = {}
+    for name in ['build.ninja', 'compile_commands.json', os.path.join('ninja', 'shuriken.json')]:
+        with open(os.path.join(str(folder), name), 'rb') as f:
+            written[name] = f.read()
+    return written
+
+def test_same_bytes_under_every_hash_seed(project, config_dir):
+    write_tree(config_dir, {'extra.cfg': 'path /opt/extra\ncompiler -I$path$/include\nlinker -L$path$/lib\nlibs -lextra\n'})
+    first = generate(project, config_dir, SEEDS[0])
+    # every feature made it into the manifest
+    for word in ['pool heavy', 'pool link', 'libcore.a', 'libtool.a', '.gch', 'unity_', 'generate', 'pgo', 'bin/debug/', 'subapp', '-I/opt/extra/include']:
+        assert word.encode() in first['build.ninja'], word
+    for seed in SEEDS[1:]:
+        again = generate(project, config_dir, seed)
+        for name in first:
+            assert again[name] == first[name], '{0} differs with PYTHONHASHSEED={1}'.format(name, seed)
+
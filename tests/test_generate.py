@@ -0,0 +1,48 @@
+import os
+
+from conftest import write_tree, run_shuriken, run_ninja, needs_toolchain
+
+MAIN = 'int main() { return 0; }\n'
+
+def link_line(folder, target):
+    with open(os.path.join(str(folder), 'build.ninja')) as f:
+        for line in f:
+            if line.startswith('build {0}: link_exe '.format(target)):
+                return line.split()[3:]
+    return None
+
+def subdir_tree(folder):
+    # a top generate line writing into a subdir, a subdir generate line
+    # selected by the top metal file, none of them written yet
+    write_tree(folder, {
+        'main.cpp': MAIN,
+        'metal': 'generate sub/gen.cpp run echo "int main() { return 0; }" > $out$\n'
+                 'subdir sub tools\n'
+                 'exec top *.cpp tools/*.cpp\n',
+        'sub/metal': 'exec subapp *.cpp\n',
+        'tools/metal': 'generate made.cpp run echo "int made(); int made() { return 1; }" > $out$\n',
+    })
+
+def test_outputs_cross_metal_files(project):
+    subdir_tree(project)
+    output = run_shuriken(project)
+    assert 'error' not in output
+    assert link_line(project, 'subapp') == ['obj/sub/gen.cpp.o']
+    assert link_line(project, 'top') == ['obj/main.cpp.o', 'obj/tools/made.cpp.o']
+
+def test_outputs_of_a_sibling(project):
+    write_tree(project, {
+        'metal': 'subdir gen app\n',
+        'gen/metal': 'generate ../app/made.cpp run echo "int main() { return 0; }" > $out$\n',
+        'app/metal': 'exec app *.cpp\n',
+    })
+    run_shuriken(project)
+    assert link_line(project, 'app') == ['obj/app/made.cpp.o']
+
+@needs_toolchain
+def test_clean_tree_builds(project):
+    subdir_tree(project)
+    run_shuriken(project)
+    run_ninja(project)
+    assert os.path.isfile(os.path.join(str(project), 'subapp'))
+    assert 'no work to do' in run_ninja(project)
@@ -0,0 +1,83 @@
+import os
+import glob
+
+import pytest
+
+import shuriken
+from conftest import write_tree
+
+TREE = ['main.cpp', 'util.c', '.hidden.cpp', 'src/a.cpp', 'src/b.hpp', 'src/x/c.cpp', 'src/x/y/d.cpp',
+        'src/x/y/z/e.cpp', 'src/.git/f.cpp', 'lib/g.cpp', 'lib/h1.cpp', 'lib/h2.cpp']
+
+PATTERNS = ['*.cpp', '*.c', 'src/*.cpp', 'src/*/*.cpp', 'src/*/*/*.cpp', 'src/**/*.cpp', 'lib/**/*.cpp',
+            'lib/h?.cpp', 'lib/[gh]*.cpp', 'lib/[!g]*.cpp', 'src/x/**', 'linked/**/*.cpp', 'linked/*/*.cpp']
+
+@pytest.fixture
+def tree(project, monkeypatch):
+    write_tree(project, dict((path, '') for path in TREE))
+    # a link to a folder is a folder, like for glob
+    os.symlink('src/x', str(project / 'linked'))
+    monkeypatch.chdir(project)
+    return project
+
+def test_compile_selector():
+    assert shuriken.compile_selector('*.cpp')[:2] == (False, '.')
+    assert shuriken.compile_selector('-src/x/*.cpp')[:2] == (True, 'src/x')
+    assert shuriken.compile_selector('!src/*.cpp')[0]
+    assert shuriken.compile_selector('src/*.cpp')[3] == 0
+    assert shuriken.compile_selector('src/*/*.cpp')[3] == 1
+    assert shuriken.compile_selector('a/*/b/*.cpp')[1:4:2] == ('a', 2)
+    assert shuriken.compile_selector('src/**/*.cpp')[3] is None
+    negate, base, regex, depth = shuriken.compile_selector('src/**/*.cpp')
+    assert regex.match('a.cpp') and regex.match('x/y/a.cpp')
+    assert not regex.match('.git/a.cpp') and not regex.match('a.hpp')
+
+@pytest.mark.parametrize('pattern', PATTERNS)
+def test_select_like_glob(tree, pattern):
+    expected = sorted(p for p in glob.glob(pattern, recursive=True) if os.path.isfile(p))
+    assert shuriken.dir_index().select([pattern]) == expected
+
+def test_negated_selectors(tree):
+    index = shuriken.dir_index()
+    assert index.select(['src/**/*.cpp', '-src/x/**']) == ['src/a.cpp']
+    assert index.select(['lib/*.cpp', '!lib/h*.cpp']) == ['lib/g.cpp']
+
+def test_depth_bounds_the_walk(tree):
+    index = shuriken.dir_index()
+    index.select(['src/*/*.cpp'])
+    assert 'src/x' in index.listings
+    assert 'src/x/y' not in index.listings
+    assert not shuriken.reaches('src', 'src/x/y', 1)
+    assert shuriken.reaches('src', 'src/x', 1)
+    assert shuriken.reaches('src', 'src/x/y/z', None)
+    assert not shuriken.reaches('src', 'lib', None)
+    assert shuriken.reaches('.', 'lib', 1) and not shuriken.reaches('.', 'lib/a', 1)
+
+def test_linked_folder_is_read_once(tree):
+    # glob takes src/x twice, through linked and through src, compiling
+    # the same files under two names
+    found = shuriken.dir_index().select(['**/*.cpp'])
+    assert found == ['lib/g.cpp', 'lib/h1.cpp', 'lib/h2.cpp', 'linked/c.cpp', 'linked/y/d.cpp', 'linked/y/z/e.cpp',
+                     'main.cpp', 'src/a.cpp']
+
+def test_link_cycle_is_read_once(tree):
+    os.symlink('..', str(tree / 'src' / 'x' / 'up'))
+    found = shuriken.dir_index().select(['src/**/*.cpp'])
+    assert found == ['src/a.cpp', 'src/x/c.cpp', 'src/x/y/d.cpp', 'src/x/y/z/e.cpp']
+
+def test_forget_reads_the_folder_again(tree):
+    index = shuriken.dir_index()
+    assert index.select(['src/**/*.cpp']) == ['src/a.cpp', 'src/x/c.cpp', 'src/x/y/d.cpp', 'src/x/y/z/e.cpp']
+    write_tree(tree, {'src/x/y/new.cpp': '', 'lib/new.cpp': ''})
+    # nothing is read again until the folder is forgotten
+    assert 'src/x/y/new.cpp' not in index.select(['src/**/*.cpp'])
+    index.forget('src/x/y')
+    assert 'src/x/y/new.cpp' in index.select(['src/**/*.cpp'])
+    assert index.select(['lib/*.cpp']) == ['lib/g.cpp', 'lib/h1.cpp', 'lib/h2.cpp', 'lib/new.cpp']
+
+def test_generated_outputs_are_selected(tree):
+    index = shuriken.dir_index()
+    index.outputs = ['src/x/made.cpp', 'other/made.cpp']
+    assert 'src/x/made.cpp' in index.select(['src/**/*.cpp'])
+    assert index.select(['src/*.cpp']) == ['src/a.cpp']
+    assert index.select(['src/**/*.cpp'], generated_only=True) == ['src/x/made.cpp']
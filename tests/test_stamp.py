@@ -0,0 +1,58 @@
+import os
+
+import shuriken
+from conftest import write_tree, run_shuriken, run_ninja, needs_toolchain
+
+MAIN = 'int main() { return 0; }\n'
+
+def test_own_files_keep_the_stamp(project, monkeypatch):
+    write_tree(project, {'main.cpp': MAIN, 'metal': 'exec app *.cpp\n'})
+    run_shuriken(project)
+    monkeypatch.chdir(project)
+    assert shuriken.is_up_to_date('build.ninja', shuriken.STAMP_FILE)
+    # what ninja writes into a folder the selectors read
+    write_tree(project, {'app': '', 'obj/main.cpp.o': ''})
+    assert shuriken.is_up_to_date('build.ninja', shuriken.STAMP_FILE)
+    # a folder whose listing was read again is remembered
+    assert shuriken.is_up_to_date('build.ninja', shuriken.STAMP_FILE)
+    write_tree(project, {'other.cpp': MAIN})
+    assert not shuriken.is_up_to_date('build.ninja', shuriken.STAMP_FILE)
+
+@needs_toolchain
+def test_no_regenerate_after_a_build(project):
+    write_tree(project, {'main.cpp': MAIN, 'metal': 'exec app *.cpp\n'})
+    run_shuriken(project)
+    assert 'regenerate' not in run_ninja(project)
+    # the link put app in the folder build.ninja depends on
+    assert 'regenerate' not in run_ninja(project)
+    assert 'no work to do' in run_ninja(project)
+
+@needs_toolchain
+def test_no_regenerate_after_a_generation(project):
+    write_tree(project, {'main.cpp': MAIN, 'metal': 'exec app *.cpp\n'})
+    run_shuriken(project)
+    run_ninja(project)
+    run_ninja(project)
+    write_tree(project, {'metal': 'exec app *.cpp\nexec tool main.cpp\n'})
+    run_shuriken(project)
+    assert 'regenerate' not in run_ninja(project)
+    assert 'no work to do' in run_ninja(project)
+    # and once more through ninja's own regenerate edge
+    write_tree(project, {'metal': 'exec app *.cpp\n'})
+    assert 'regenerate' in run_ninja(project)
+    assert 'no work to do' in run_ninja(project)
+
+@needs_toolchain
+def test_deleted_unity_source_is_written_again(project):
+    write_tree(project, {'a.cpp': MAIN, 'b.cpp': '', 'metal': 'exec app *.cpp\nunity app\n'})
+    run_shuriken(project)
+    run_ninja(project)
+    unity = [p for p in shuriken_outputs(project) if '/unity/' in p]
+    assert unity
+    os.remove(os.path.join(str(project), unity[0]))
+    assert 'regenerate' in run_ninja(project)
+    assert os.path.isfile(os.path.join(str(project), unity[0]))
+
+def shuriken_outputs(folder):
+    with open(os.path.join(str(folder), 'build.ninja')) as f:
+        return [line[len('build '):-len(': phony\n')] for line in f if line.endswith(': phony\n')]
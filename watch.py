@@ -0,0 +1,160 @@
+import os
+import sys
+import time
+import ctypes
+import ctypes.util
+import struct
+import select
+import subprocess
+
+import shuriken
+
+# keeps the parsed project in memory and regenerates build.ninja as soon as
+# inotify reports a change to the metal files, the .cfg files or the
+# folders the selectors read
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_ONLYDIR = 0x01000000
+ENTRIES_CHANGED = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO
+WATCH_MASK = IN_CLOSE_WRITE | ENTRIES_CHANGED | IN_DELETE_SELF | IN_ONLYDIR
+
+# written by shuriken itself, temporary files included
+OWN_FILES = ('build.ninja', shuriken.STAMP_FILE, shuriken.COMPDB_FILE)
+
+class inotify():
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.folders = {}
+
+    def add(self, folder):
+        if folder in self.folders.values():
+            return
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(folder), WATCH_MASK)
+        if wd >= 0:
+            self.folders[wd] = folder
+
+    def read(self, delay):
+        # blocks for the first event, then gathers the ones following it
+        # within delay, a save or a checkout is many events at once
+        events = []
+        timeout = None
+        while True:
+            ready = select.select([self.fd], [], [], timeout)[0]
+            if not ready:
+                return events
+            data = os.read(self.fd, 1 << 16)
+            pos = 0
+            while pos < len(data):
+                wd, mask, cookie, size = struct.unpack_from('iIII', data, pos)
+                name = data[pos + 16:pos + 16 + size].rstrip(b'\0').decode()
+                pos += 16 + size
+                if mask & IN_IGNORED:
+                    self.folders.pop(wd, None)
+                elif mask & IN_Q_OVERFLOW:
+                    events.append((None, '', mask))
+                elif wd in self.folders:
+                    events.append((self.folders[wd], name, mask))
+            timeout = delay
+
+def watched_folders(par):
+    folders = set(d for d in par.regen_inputs if os.path.isdir(d))
+    folders.add(shuriken.config_folder())
+    folders.update(os.path.dirname(p) or '.' for p in par.regen_inputs if os.path.basename(p) == 'metal')
+    return sorted(folders)
+
+def run_ninja(args):
+    start = time.perf_counter()
+    code = subprocess.call(['ninja'] + args)
+    print('-- ninja {0} in {1:.2f}s'.format('done' if code == 0 else 'failed', time.perf_counter() - start))
+
+def watch(path_to_metal, build=False, ninja_args=(), delay=0.05):
+    os.chdir(os.path.dirname(path_to_metal))
+    metal = os.path.basename(path_to_metal)
+    notify = inotify()
+    par = shuriken.load_project(metal, shuriken.get_config_files())
+    shuriken.write_project(par)
+    shuriken.restat_log(par)
+    for folder in watched_folders(par):
+        notify.add(folder)
+    print('-- watching', len(notify.folders), 'folders')
+    if build:
+        run_ninja(list(ninja_args))
+    while True:
+        events = notify.read(delay)
+        start = time.perf_counter()
+        reload = False
+        folders = set()
+        touched = False
+        for folder, name, mask in events:
+            if folder is None:
+                # inotify dropped events, nothing is known anymore
+                reload = True
+                continue
+            path = shuriken.in_folder(name, folder)
+            if name.endswith('.tmp') or path in OWN_FILES or path in par.graph:
+                continue
+            if folder == shuriken.config_folder():
+                # a .cfg added or removed changes what configlib finds
+                reload = reload or name.endswith('.cfg')
+                continue
+            touched = True
+            if path in par.regen_inputs and not mask & IN_ISDIR:
+                # a metal file
+                reload = True
+            elif mask & ENTRIES_CHANGED:
+                folders.add(folder)
+                if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                    folders.add(path)
+        regenerated = False
+        if reload:
+            par = shuriken.load_project(metal, shuriken.get_config_files())
+            regenerated = True
+        elif folders:
+            # every folder has to be refreshed, don't stop at the first change
+            regenerated = any([par.refresh_folder(folder) for folder in sorted(folders)])
+        if regenerated:
+            par.collect_regen_inputs(metal)
+            shuriken.write_project(par)
+            shuriken.restat_log(par)
+            for folder in watched_folders(par):
+                notify.add(folder)
+            print('-- regenerated build.ninja in {0:.1f}ms'.format((time.perf_counter() - start) * 1000))
+        elif folders:
+            # the listings changed but not the selection, the stamp has to
+            # know or ninja's regenerate edge would run shuriken again
+            par.collect_regen_inputs(metal)
+            shuriken.write_listings(par)
+            shuriken.write_stamp(par)
+            shuriken.restat_log(par)
+        if build and touched:
+            run_ninja(list(ninja_args))
+
+def main(args):
+    import argparse
+    parser = argparse.ArgumentParser(prog='shuriken watch', description='regenerate build.ninja whenever the project changes')
+    parser.add_argument('-b', '--build', action='store_true', help='run ninja after every change')
+    parser.add_argument('ninja_args', nargs='*', help='arguments given to ninja with --build')
+    opts = parser.parse_args(args)
+    metal_file = os.path.join(os.getcwd(), 'metal')
+    if not os.path.isfile(metal_file):
+        print('no metal file found')
+        return 1
+    try:
+        watch(metal_file, opts.build, opts.ninja_args)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))